@@ -5,26 +5,48 @@
 import ktl
 import APF as APFLib
 import APFTask
+import hitList
+import starlistFilter
+import slewModel
+import stateBus
+import exposurePredictor
+import transparency
+import windForecast
+import telemetry
+from phaseGraph import parallel
 
 import subprocess
+import threading
+import signal
 import time
 import os
 import math
+from collections import deque
 from datetime import datetime, timedelta
 
 import numpy as np
 
 from apflog import *
 
-m1 = 22.8
+m1 = exposurePredictor.m1
 windlim = 40.0
 slowlim = 100
 WINDSHIELD_LIMIT = 10.
 wxtimeout = timedelta(seconds=1800)
 
+# Longest any keyword read in the watcher's decision loop may block, seconds
+KTL_TIMEOUT = 10
+# Longest the robot scripts may run, seconds
+CAL_TIMEOUT   = 3600
+FOCUS_TIMEOUT = 3600
+OPEN_TIMEOUT  = 900
+CLOSE_TIMEOUT = 900
+
 ScriptDir = '$LROOT/bin/robot/'
+# Where the master keeps its files: last observation number, scheduler output, hit list
+MasterDir = '/u/rjhanson/master/'
 
-deckscale = {'M': 1.0, 'W':1.0, 'N': 3.0, 'B': 0.5, 'S':2.0, 'P':1.0}
+deckscale = exposurePredictor.deckscale
 
 
 # Aquire the ktl services and associated keywords
@@ -48,23 +70,55 @@ motor      = ktl.Service('apfmot')
 decker     = motor['DECKERNAM']
 
 
-def cmdexec(cmd, debug=False, cwd='./'):
+def cmdexec(cmd, debug=False, cwd='./', timeout=None, token=None):
+    """ Runs a command, returning (success, exit code). The command is killed if it runs longer than timeout seconds,
+    or if the cancellation token is cancelled, in which case the exit code is negative. The command runs in its own
+    process group, so the scripts' children are killed with it. """
     args = cmd.split()
-    p = subprocess.Popen(args, stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=cwd)
+    p = subprocess.Popen(args, stdout=subprocess.PIPE,stderr=subprocess.STDOUT,cwd=cwd, close_fds=True, preexec_fn=os.setsid)
     
     apflog("Executing Command: %s" % repr(cmd), echo=True)
+    # Read the output in a thread, so waiting on the command never blocks on a quiet pipe.
+    # Children of the command may hold the pipe open after it exits, so only the reader closes it.
+    def reader():
+        try:
+            for l in iter(p.stdout.readline, ''):
+                if debug: apflog(l.rstrip('\n'), echo=debug)
+        finally:
+            p.stdout.close()
+    rt = threading.Thread(target=reader, name='cmdexec')
+    rt.daemon = True
+    rt.start()
+
+    start = time.time()
+    killed = False
     while p.poll() is None:
-        l = p.stdout.readline().rstrip('\n')
-        if debug: apflog(l, echo=debug)
-
-    out, err = p.communicate()
-    if debug: apflog(out, echo=debug)
+        if not killed and token is not None and token.cancelled:
+            apflog("Cancelled, killing command: %s" % repr(cmd), echo=True)
+            killed = killGroup(p)
+        elif not killed and timeout is not None and time.time() - start > timeout:
+            apflog("Command ran longer than %d s, killing it: %s" % (timeout, repr(cmd)), level='error', echo=True)
+            killed = killGroup(p)
+        time.sleep(0.2)
+
+    elapsed = time.time() - start
+    rt.join(5)
     ret_code = p.returncode
+    apflog("Command finished with exit code %d after %.0f s: %s" % (ret_code, elapsed, repr(cmd)))
     if ret_code == 0:
         return True, ret_code
     else:
         return False, ret_code
 
+def killGroup(p):
+    """Kills a process started by cmdexec and everything else in its process group."""
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        # The group is already gone
+        pass
+    return True
+
 
 
 # Callback for seeing conditions
@@ -91,6 +145,10 @@ Value <= 1.0 corresponds to good seeing """
         APF.speedlist.append(speed)
         APF.speedlist = APF.speedlist[-100:]
     APF.slowdown = 1/np.median(APF.speedlist)
+    APF.speedhist.append((time.time(), speed))
+    APF.transparency.add(speed, cntrate)
+    APF.rollup.add('countrate', cntrate)
+    APF.rollup.add('transparency', speed)
     if APF.slowdown < 1.3 :
         APF.conditions = 'good'
     else:
@@ -106,6 +164,8 @@ def fwhmmon(fwhm):
         APF.seeinglist.append(seeing)
         APF.seeinglist = APF.seeinglist[-15:]
     APF.seeing = np.median(np.array(APF.seeinglist,dtype=float))
+    APF.seeinghist.append((time.time(), seeing))
+    APF.rollup.add('seeing', seeing)
 
 # Callback for ok2open permission
 # -- Check that if we fall down a logic hole we don't error out
@@ -118,6 +178,7 @@ def okmon(ok2open):
         ok = False
     # Also need to check for cloud cover. This could require moving this call below the condition checking code.
     APF.openOK = ok
+    APF.windforecast.addOK(bool(ok))
 
 
 # Callback for the windspeed
@@ -126,6 +187,8 @@ def windmon(wx):
     wvel = checkapf['AVGWSPEED'].read(binary=True)
     # Direction needs to be stored in Radians for the calcs below
     waz  = checkapf['AVGWDIR'].read(binary=True) * np.pi/180.
+    APF.windforecast.add(wvel, waz)
+    APF.rollup.add('wvel', wvel)
     if APF.wslist == []:
         APF.wslist = [wvel]*20
         APF.wdlist = [waz]*20
@@ -145,6 +208,22 @@ def windmon(wx):
 
 
 
+# Callback for the guider counts
+def countsmon(counts):
+    APF.rollup.add('counts', counts.read(binary=True))
+
+
+# Callback for the telescope position
+def slewmon(keyword):
+    """ Feeds telescope position updates to the slew time model. """
+    try:
+        az = float(APF.aaz.binary)
+        el = float(APF.ael.binary)
+    except (TypeError, ValueError):
+        return
+    APF.slewmodel.record(time.time(), az, el)
+
+
 # Callback for Deadman timer
 def dmtimemon(dmtime):
     APF.dmtime = dmtime.read(binary=True)
@@ -181,9 +260,22 @@ class APF:
     conditions = 'bad'
     slowdown   = 0.0 
 
+    # Time stamped transparency (1/slowdown) and seeing history for the exposure time predictor
+    speedhist   = deque(maxlen=20000)
+    seeinghist  = deque(maxlen=5000)
+    predictor   = exposurePredictor.ExposurePredictor()
+    transparency = transparency.TransparencyMonitor()
+
     # Initial Wind conditions
     wslist = []
     wdlist = []
+    windforecast = windForecast.WindForecaster()
+
+    # Slew time model, fitted from the telescope position history
+    slewmodel = None
+
+    # 1 s, 1 min and 10 min rollups of the guider and weather telemetry
+    rollup = None
 
     # KTL Services and Keywords
     tel        = ktl.Service('eostele')
@@ -214,11 +306,28 @@ class APF:
     motor      = ktl.Service('apfmot')
     decker     = motor['DECKERNAM']
 
-    def __init__(self, task="example", test=False):
-        """ Initilize the current state of APF. Setup the callbacks and monitors necessary for automated telescope operation."""
+    def __init__(self, task="example", test=False, datadir=None):
+        """ Initilize the current state of APF. Setup the callbacks and monitors necessary for automated telescope operation.
+        datadir is where the hit list and the slew, exposure and telemetry history are written. Only the master passes one, other instances keep theirs in memory."""
         # Set up the calling task that set up the monitor and if this is a test instance
         self.test = test
         self.task = task
+        # Cancellation token of the thread currently driving the telescope, checked by long running commands
+        self.token = None
+        # robot.csh processes started by observe that haven't been reaped yet
+        self.robotprocs = []
+
+        # Only one process may write the hit list, slew history, exposure calibration and telemetry files
+        if datadir is None:
+            # Indexed record of completed observations, also maintains the text hit_list
+            self.hitlist = hitList.HitList(None, None)
+            APF.slewmodel = slewModel.SlewModel(None)
+            APF.rollup = telemetry.RollupStore(None)
+        else:
+            self.hitlist = hitList.HitList(os.path.join(datadir, 'hit_list.idx'), os.path.join(datadir, 'hit_list'))
+            APF.slewmodel = slewModel.SlewModel(os.path.join(datadir, 'slews.txt'))
+            APF.predictor = exposurePredictor.ExposurePredictor(path=os.path.join(datadir, 'exposure_calibration.txt'))
+            APF.rollup = telemetry.RollupStore(os.path.join(datadir, 'telemetry'))
   
         # Set the callbacks and monitors
         self.wx.callback(windmon)
@@ -239,13 +348,16 @@ class APF:
         self.teqmode.monitor()
         self.vmag.monitor()
         self.ldone.monitor()
+        self.counts.callback(countsmon)
         self.counts.monitor()
         self.decker.monitor()
         self.mv_perm.monitor()
         self.chk_close.monitor()
 
         self.sunel.monitor()
+        self.aaz.callback(slewmon)
         self.aaz.monitor()
+        self.ael.callback(slewmon)
         self.ael.monitor()
         self.fspos.monitor()
         self.rspos.monitor()
@@ -258,44 +370,41 @@ class APF:
         self.countrate.poll()
         self.ok2open.poll()
 
-    def __str__(self):
-        # Determine if the sun rising / setting check is working
-        now = datetime.now()
-        if now.strftime("%p") == 'AM':
-            rising = True
-        else:
-            rising = False
-        s = ''
-        s += "At %s state of telescope is:\n" % str(now)
-        s += "Sun elevation = %4.2f %s\n" % (self.sunel, "Rising" if rising else "Setting")
-        s += "Telescope -- AZ=%4.2f  EL=%4.2f \n" % (self.aaz, self.ael)
-        s += "Front/Rear Shutter=%4.2f / %4.2f\n"%(self.fspos, self.rspos)
-        s += "Wind = %3.1f mph @ %4.1f deg\n" % (self.wvel, self.waz)
-        s += "Seeing %4.2f arcsec\n" % self.seeing
-        s += "Slowdown = %5.2f x\n" % self.slowdown
-        #s += "Conditions are - %s\n" % self.conditions
-        s += "Teq Mode - %s\n" % self.teqmode
-        s += "M2 Focus Value = % 4.3f\n" % self.aafocus
-        s += "Okay to open = %s -- %s\n" % (repr(self.openOK), self.checkapf['OPREASON'].read() )
-        s += "Current Weather = %s\n" % self.checkapf['WEATHER'].read()
+    def state(self):
+        """Returns the current state of the telescope, raw keywords and derived values, as a dictionary."""
         isopen, what = self.isOpen()
-        if isopen:
-            s += "Currently open: %s\n" % what
-        else:
-            s += "Not currently open\n"
         ripd, rr = self.findRobot()
-        if rr:
-            s += "Robot is running\n"
-        else:
-            s += "Robot is not running\n"
+        st = dict()
+        st['time']       = time.time()
+        st['sunel']      = float(self.sunel)
+        st['aaz']        = float(self.aaz)
+        st['ael']        = float(self.ael)
+        st['fspos']      = float(self.fspos)
+        st['rspos']      = float(self.rspos)
+        st['aafocus']    = float(self.aafocus)
+        st['wvel']       = float(self.wvel)
+        st['waz']        = float(self.waz)
+        st['seeing']     = float(self.seeing)
+        st['slowdown']   = float(self.slowdown)
+        st['dmtime']     = float(self.dmtime)
+        st['openOK']     = bool(self.openOK)
+        st['isopen']     = isopen
+        st['running']    = rr
+        st['conditions'] = self.conditions
+        st['teqmode']    = str(self.teqmode)
+        st['whatsopen']  = what
+        st['opreason']   = self.checkapf['OPREASON'].read()
+        st['weather']    = self.checkapf['WEATHER'].read()
+        return st
 
-        return s
+    def __str__(self):
+        return stateBus.formatState(self.state())
 
 
     # Fucntion for checking what is currently open on the telescope
     def isOpen(self):
         """Returns the state of checkapf.WHATSOPN as a tuple (bool, str)."""
-        what = self.checkapf("WHATSOPN").read()
+        what = self.checkapf("WHATSOPN").read(timeout=KTL_TIMEOUT)
         if "DomeShutter" in what or "MirrorCover" in what or "Vents" in what:
             return True, what
         else:
@@ -304,16 +413,16 @@ class APF:
     def setObserverInfo(self, num=100, name='Robot'):
         if self.test: return
         apflog("Setting science camera parameters.")
-        self.ucam('OBSERVER').write(name)
-        self.ucam('OBSNUM').write(str(num))
-        self.ucam('OUTDIR').write('/data/apf/')
-        self.ucam('OUTFILE').write(name)
+        # The keywords are independent, so write and read them back all at once
+        values = [('OBSERVER', name), ('OBSNUM', str(num)), ('OUTDIR', '/data/apf/'), ('OUTFILE', name)]
+        parallel([lambda k=k, v=v: self.ucam(k).write(v) for k, v in values])
+        observer, obsnum, outdir, outfile = parallel([lambda k=k: self.ucam(k).read() for k, v in values])
 
         apflog("Upadted science camera parameters:")
-        apflog("Observer = %s" % self.ucam('OBSERVER').read(),echo=True)
-        apflog("Output directory = %s" % self.ucam('OUTDIR').read(),echo=True)
-        apflog("Observation number = %s" % self.ucam('OBSNUM').read(), echo=True)
-        apflog("File prefix = %s" % self.ucam('OUTFILE').read(), echo=True)
+        apflog("Observer = %s" % observer,echo=True)
+        apflog("Output directory = %s" % outdir,echo=True)
+        apflog("Observation number = %s" % obsnum, echo=True)
+        apflog("File prefix = %s" % outfile, echo=True)
 
         
 
@@ -325,7 +434,7 @@ class APF:
         if time == 'pre' or 'post':
             apflog("Running calibrate %s %s" % (script, time), level = 'info')
             cmd = '/usr/local/lick/bin/robot/calibrate %s %s' % (script, time)
-            result, code = cmdexec(cmd)
+            result, code = cmdexec(cmd, timeout=CAL_TIMEOUT, token=self.token)
             if not result:
                 apflog("Calibrate %s %s failed with return code %d" % (script, time, code),echo=True)
             return result
@@ -342,7 +451,7 @@ class APF:
             else:
                 apflog("Running FocusCube routine.",echo=True)
                 cmd = '/u/user/devel_scripts/ucscapf/auto_focuscube.sh pre t'
-                result, code = cmdexec(cmd,cwd='/u/user/devel_scripts/ucscapf')
+                result, code = cmdexec(cmd,cwd='/u/user/devel_scripts/ucscapf', timeout=FOCUS_TIMEOUT, token=self.token)
                 if not result:
                     apflog("Focuscube failed with code %d" % code, echo=True)
                 return result
@@ -398,11 +507,11 @@ class APF:
 
         # Make two tries at opening. If they both fail return False so the caller can act
         # accordingly.
-        result, code = cmdexec(cmd)
+        result, code = cmdexec(cmd, timeout=OPEN_TIMEOUT, token=self.token)
         if not result:
             apflog("First openup attempt has failed. Exit code = %d. After a pause, will make one more attempt." % code,echo=True)
             APFLib.waitFor(self.task, True, timeout=10)
-            result, code = cmdexec(cmd)
+            result, code = cmdexec(cmd, timeout=OPEN_TIMEOUT, token=self.token)
             if result:
                 return True
             else:
@@ -429,7 +538,7 @@ class APF:
         close_start = datetime.now()
         while (datetime.now() - close_start).seconds < 1800:
             attempts += 1
-            result, code = cmdexec(cmd)
+            result, code = cmdexec(cmd, timeout=CLOSE_TIMEOUT)
             if not result:
                 apflog("Closeup failed with exit code %d" % code, echo=True)
                 if attempts == 3:
@@ -454,29 +563,16 @@ class APF:
         pass
 
     def updateLastObs(self):
-        """ If the last observation was a success, this function updates the file storing the last observation number and the hit_list which is required by the dynamic scheduler."""
-        result = self.robot['SCRIPTOBS_STATUS'].read()
-        with open('/u/rjhanson/master/lastObs.txt','w') as f:
-                f.write("%s\n" % self.ucam('OBSNUM').read())
-                apflog("Recording last ObsNum as %d" % int(self.ucam["OBSNUM"].read()))
-        if result == 'Exited/Failure':
-            # Last observation failed, so no need to update files
-            return
-        elif result == 'Exited/Success':            
-            try:
-                f = open("/u/rjhanson/master/apf_sched.txt",'r')
-            except IOError:
-                pass
-            else:
-                for line in f:
-                    if line.strip() != '':
-                        with open('/u/rjhanson/master/hit_list','a') as o:
-                            o.write(line + '\n')
-                f.close()
+        """ Updates the file storing the last observation number. The hit_list required by the dynamic scheduler
+        is updated by the master as each observation finishes."""
+        obsnum = self.ucam('OBSNUM').read(timeout=KTL_TIMEOUT)
+        with open(os.path.join(MasterDir, 'lastObs.txt'),'w') as f:
+                f.write("%s\n" % obsnum)
+                apflog("Recording last ObsNum as %d" % int(obsnum))
 
     def updateWindshield(self, state):
         """Checks the current windshielding mode, and depending on the input and wind speed measurements makes sure it is set properly."""
-        currState = self.robot["SCRIPTOBS_WINDSHIELD"].read().strip().lower()
+        currState = self.robot["SCRIPTOBS_WINDSHIELD"].read(timeout=KTL_TIMEOUT).strip().lower()
         if state == 'on':
             if currState != 'enable':
                 APFLib.write(self.robot["SCRIPTOBS_WINDSHIELD"], "Enable")
@@ -484,13 +580,76 @@ class APF:
             if currState != 'disable':
                 APFLib.write(self.robot["SCRIPTOBS_WINDSHIELD"], "Disable")
         else:
-            # State must be auto, so check wind
-            if currState == 'enable' and self.wvel <= WINDSHIELD_LIMIT:
+            # State must be auto, so check the wind forecast. It switches on ahead of rising wind,
+            # and holds on until the forecast is comfortably below the limit.
+            shield = self.windforecast.windshield(WINDSHIELD_LIMIT)
+            if currState == 'enable' and not shield:
                 APFLib.write(self.robot["SCRIPTOBS_WINDSHIELD"], "Disable")
-            if currState == 'disable' and self.wvel > WINDSHIELD_LIMIT:
+            if currState == 'disable' and shield:
                 APFLib.write(self.robot["SCRIPTOBS_WINDSHIELD"], "Enable")
 
 
+    def predictExposureTimes(self, vmag, texp, expcount, decker=None):
+        """ Estimates the exposure time of each target from the recent slowdown and seeing history.
+        Takes arrays of the star list vmag, texp and expcount values. Returns arrays of the median, low and high estimates in seconds."""
+        if decker is None:
+            try:
+                decker = self.decker.binary[0]
+            except (TypeError, IndexError):
+                decker = 'W'
+        return self.predictor.predict(vmag, texp, expcount, decker, list(self.speedhist), list(self.seeinghist))
+
+    def predictStarlist(self, sl):
+        """Runs predictExposureTimes on a parsed star list."""
+        return self.predictExposureTimes(sl.column('vmag'), sl.column('texp'), sl.column('expcount'))
+
+    def exposureFinished(self, line, start, end):
+        """Feeds a completed exposure of a star list line to the exposure time predictor."""
+        kw = dict()
+        for item in line.split()[7:]:
+            if '=' in item:
+                k, v = item.split('=', 1)
+                kw[k.lower()] = v
+        def value(key):
+            try:
+                return float(kw[key])
+            except (KeyError, ValueError):
+                return float('nan')
+        speeds = [v for t, v in list(self.speedhist) if start <= t <= end]
+        seeings = [v for t, v in list(self.seeinghist) if start <= t <= end]
+        if not speeds or not seeings:
+            return
+        try:
+            decker = self.decker.binary[0]
+        except (TypeError, IndexError):
+            decker = 'W'
+        self.predictor.addExposure(value('vmag'), value('expcount'), value('texp'), end - start, decker, np.median(speeds), np.median(seeings))
+
+    def orderStarlist(self, observation):
+        """ Reorders a star list to minimize the predicted slew time from the current telescope position.
+        Returns the name of the reordered star list."""
+        root, ext = os.path.splitext(observation)
+        outfile = root + "_slew" + ext
+        before, after = slewModel.orderStarlist(observation, outfile, self.slewmodel, float(self.aaz), float(self.ael))
+        apflog("Reordered %s into %s. Predicted slew time %.0f s, was %.0f s, saving %.0f s." % (observation, outfile, after, before, before - after), echo=True)
+        return outfile
+
+    def filterStarlist(self, observation):
+        """ Drops targets that can't be observed right now from a star list, and logs why.
+        Returns the name of the filtered star list, or None if nothing in it is observable."""
+        root, ext = os.path.splitext(observation)
+        outfile = root + "_obs" + ext
+        try:
+            kept, dropped = starlistFilter.filterStarlist(observation, outfile, wvel=self.wvel, waz=self.waz, predict=self.predictStarlist)
+        except IOError:
+            apflog("Couldn't read star list %s to check observability." % observation, echo=True)
+            return None
+        for name, reason in dropped:
+            apflog("Dropping %s from %s: %s" % (name, observation, reason), echo=True)
+        if kept == 0:
+            return None
+        return outfile
+
     def observe(self, observation, skip=0):
         """ Currently: Takes a string which is the filename of a properly formatted star list. """
 
@@ -507,22 +666,60 @@ class APF:
             self.setTeqMode('Night')
         # Check Focus
         robotdir = "/u/user/devel_scripts/robot/"
-        infile = open(observation,'r')
-        outfile = open('robot.log', 'a')
         if skip != 0:
-            args = ['./robot.csh', '-dir', '/u/rjhanson/master/','-skip', str(skip)]
+            args = ['./robot.csh', '-dir', MasterDir,'-skip', str(skip)]
         else:
-            args = ['./robot.csh', '-dir', '/u/rjhanson/master/'] 
-        p = subprocess.Popen(args,stdin=infile, stdout=outfile,stderr = subprocess.PIPE, cwd=robotdir)
-           
+            args = ['./robot.csh', '-dir', MasterDir] 
+        self.reapRobot()
+        apflog("Starting robot.csh on %s" % observation)
+        # The robot gets its own copies of the files, so ours are closed straight away.
+        # Its errors go to robot.log too, where the master reads them, rather than to a pipe nobody reads.
+        with open(observation,'r') as infile:
+            with open('robot.log', 'a') as outfile:
+                p = subprocess.Popen(args,stdin=infile, stdout=outfile,stderr=subprocess.STDOUT, cwd=robotdir, close_fds=True)
+        self.robotprocs.append(p)
+
+    def reapRobot(self):
+        """Collects the exit status of finished robot.csh processes so they don't linger as zombies. Returns how many are still running."""
+        running = []
+        for p in self.robotprocs:
+            code = p.poll()
+            if code is None:
+                running.append(p)
+            else:
+                apflog("robot.csh (pid %d) exited with code %d" % (p.pid, code))
+        self.robotprocs = running
+        return len(running)
         
+    def closureLikely(self, duration):
+        """Returns True if the wind forecast or a flapping OPEN_OK say we will likely have to close within duration seconds."""
+        return self.windforecast.closeLikely(windlim, duration)
+
+    def cloudedOut(self, elapsed, exptime):
+        """ Returns True if clouds mean the current exposure can no longer reach a useful fraction of its count threshold.
+        elapsed and exptime are the seconds since the exposure started and its maximum length."""
+        try:
+            cnts = float(self.counts.read(binary=True, timeout=KTL_TIMEOUT))
+            thr  = float(self.thresh.read(binary=True, timeout=KTL_TIMEOUT))
+        except (TypeError, ValueError):
+            return False
+        return self.transparency.shouldAbort(cnts, thr, elapsed, exptime)
+
+    def stopExposure(self):
+        """Ends the current exposure early. The frame is read out and kept, and the robot moves on to its next target."""
+        apflog("Stopping the current exposure early.", echo=True)
+        if self.test:
+            print "Test Mode: Would be stopping the current exposure."
+            return
+        APFLib.write(self.ucam['STOP'], True)
+
     def DMReset(self):
         APFLib.write(self.checkapf['ROBOSTATE'], "master operating")
         
 
     def findRobot(self):
         """Trys to find a running instance of robot.csh. Returns the PID along with a boolean representing if the robot was succesfully found."""
-        rpid = self.robot['SCRIPTOBS_PID'].read(binary=True)
+        rpid = self.robot['SCRIPTOBS_PID'].read(binary=True, timeout=KTL_TIMEOUT)
         if rpid == '' or rpid == -1:
             return rpid, False
         else:
@@ -535,9 +732,9 @@ class APF:
         if now:
             apflog("Abort exposure, terminating robot now.")
         else:
-            if not ucam['EVENT_STR'].read() == "ControllerReady":
+            if not ucam['EVENT_STR'].read(timeout=KTL_TIMEOUT) == "ControllerReady":
                 apflog("Waiting for current exposure to finish.")
-                ucam['EVENT_STR'].waitfor(" = ReadoutBegin", timout=1200)
+                ucam['EVENT_STR'].waitfor('== ReadoutBegin', timeout=1200)
         apflog("Killing Robot.")
         ripd, running = self.findRobot()
         if running:
@@ -548,16 +745,23 @@ class APF:
 if __name__ == '__main__':
     print "Testing telescope monitors, grabbing and printing out current state."
 
-    task = 'example'
+    # If the state bus daemon is running, read from it rather than setting up our own monitors
+    bus = stateBus.connect()
+    if bus is not None:
+        print "Reading telescope state from %s" % bus.path
+        current = lambda: stateBus.formatState(bus.snapshot()[0])
+    else:
+        task = 'example'
 
-    APFTask.establish(task, os.getpid())
-    apf = APF(task=task,test=False)
+        APFTask.establish(task, os.getpid())
+        apf = APF(task=task,test=False)
 
-    # Give the monitors some time to start up
-    APFTask.waitFor(task, True,timeout=10)
+        # Give the monitors some time to start up
+        APFTask.waitFor(task, True,timeout=10)
+        current = lambda: str(apf)
 
     
-    print str(apf)
+    print current()
 
     while True:
         try:
@@ -566,7 +770,7 @@ if __name__ == '__main__':
         except KeyboardInterrupt:
             break
         else:
-            print str(apf)
+            print current()
 
 
         
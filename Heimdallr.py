@@ -9,6 +9,7 @@ import sys
 import os
 import threading
 import subprocess
+import traceback
 from select import select
 from datetime import datetime, timedelta
 import argparse
@@ -17,6 +18,14 @@ import ktl
 import APF as APFLib
 import APFTask
 import APFControl as ad
+import robotLog
+import hitList
+import obsQueue
+import starlistFilter
+import phaseGraph
+import supervisor
+import profiler
+import resourceWatch
 
 from apflog import *
 import schedulerHelper as sh
@@ -27,6 +36,12 @@ success = False
 
 parent = 'master'
 
+# Where the butler logsheet lives
+ButlerPath = r"/u/user/starlists/ucsc/"
+
+# Single line star list handed to the robot for each queued request
+ObsFile = 'master_obs.txt'
+
 
 def shutdown():
     if success == True:
@@ -49,33 +64,47 @@ atexit.register (shutdown)
 def args():
     p_c = ["ObsInfo", "Focus", "Cal-Pre", "Cal-Post", "Watching"]
     w_c = ["on", "off", "auto"]
+    o_c = ["file", "slew"]
     parser = argparse.ArgumentParser(description="Set default options")
     parser.add_argument('-n','--name', default='ucsc', help='Specify the observer name - used in file names')
     parser.add_argument('-o','--obsnum', type=int, help='Specify the observation number used to set the UCAM and file names.')
     parser.add_argument('-p', '--phase', choices=p_c, help='Specify the starting phase of the watcher. Allows for skipping standard proceedures.')
     parser.add_argument('-f','--fixed', help='Specify a fixed target list to observe. File will be searched for relative to the current working directory.')
     parser.add_argument('-t','--test', action='store_true', help="Start the watcher in test mode. No modification to telescope, instrument, or observer settings will be made.")
-    parser.add_argument('-r', '--restart', action='store_true', default=False, help="Restart the specified fixed star list from the begining. This resets scriptobs_lines_done to 0.")
+    parser.add_argument('-r', '--restart', action='store_true', default=False, help="Restart the specified fixed star list from the begining. This resets scriptobs_lines_done and the master fixed list progress to 0.")
     parser.add_argument('-w', '--windshield', choices=w_c, default='auto', help="Turn windshielding on, off, or let the software decide based on the current average wind speed (Default is auto). Velocity > 5 mph turns windshielding on.")
+    parser.add_argument('--order', choices=o_c, default='file', help="Observe a fixed list in file order, or reorder it to minimize slew time (Default is file). A reordered list is written next to the original and reused when the same list is restarted.")
+    parser.add_argument('--tracemalloc', action='store_true', default=False, help="Trace memory allocations and log the top allocation sites when memory use grows. Slows the master down, and needs Python 3.")
     parser.add_argument('-c', '--calibrate', default='ucsc', type=str, help="Specify the calibrate script to use. Specify string to be used in calibrate 'arg' pre/post")
 
     opt = parser.parse_args()
     return opt
 
 
-def findObsNum():
-    # Where the butler logsheet lives
-    butlerPath = r"/u/user/starlists/ucsc/"
+def lastLine(filename, block=4096):
+    """Returns the last non-empty line of a file, reading only the end of it."""
+    with open(filename, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        pos = end
+        data = ''
+        while pos > 0:
+            pos = max(0, pos - block)
+            f.seek(pos)
+            data = f.read(end - pos)
+            lines = [l for l in data.splitlines() if l.strip() != '']
+            if len(lines) > 1 or (lines and pos == 0):
+                return lines[-1]
+    return ''
+
+def findObsNum(butlerPath=ButlerPath):
     # Grab the names of all the files in the butlerPath directory
     (_, _, filenames) = os.walk(butlerPath).next()
     # Open the latest logsheet and grab the last line
-    with open(butlerPath+sorted(filenames)[-1],'r') as f:
-        txt = f.readlines()
-    last = float(txt[-1].split()[0])
+    last = float(lastLine(os.path.join(butlerPath, max(filenames))).split()[0])
     
     # Don't know if night_watchman or watcher was run last, so check obs num of both
-    myPath = r"./"
-    with open('/u/rjhanson/master/lastObs.txt','r') as f:
+    with open(os.path.join(ad.MasterDir, 'lastObs.txt'),'r') as f:
         l = f.readline()
         obs = float(l.strip())
 
@@ -105,6 +134,22 @@ def getTotalLines(filename):
 
     
 
+def exposureLength(ev, req, default=1200.):
+    """Maximum length of an exposure in seconds, from the robot event or the texp of the star list line."""
+    try:
+        return float(ev['texp'])
+    except (KeyError, ValueError):
+        pass
+    if req is not None:
+        for item in req.line.split():
+            if item.lower().startswith('texp='):
+                try:
+                    return float(item.split('=', 1)[1])
+                except ValueError:
+                    break
+    return default
+
+
 class Master(threading.Thread):
     def __init__(self, apf, user='ucsc'):
         threading.Thread.__init__(self)
@@ -113,121 +158,321 @@ class Master(threading.Thread):
         self.name = 'watcher'
         self.signal = True
         self.windshield = 'auto'
+        self.robotlog = None
+        self.target = None
+        self.fixedList = None
+        self.fixedLoaded = False
+        self.queue = obsQueue.ObsQueue()
+        self.current = None
+        self.exposureStart = None
+        self.exposureTime = None
+        # Exit status of a watcher that gave up with sys.exit, for the main thread to exit with
+        self.exitStatus = None
+        self.daemon = True
+        self.token = supervisor.CancelToken()
+        self.heartbeat = time.time()
+
+    def checkRobotEvents(self):
+        """ Logs the events parsed from the robot output since the last check, and tracks the current target. """
+        if self.robotlog is None:
+            return
+        for ev in self.robotlog.pending():
+            if ev['event'] == 'acquired':
+                self.target = ev['target']
+                apflog("Robot acquired %s" % self.target, echo=True)
+            elif ev['event'] == 'exposure_start':
+                apflog("Exposure of %s started" % self.target, echo=True)
+                self.exposureStart = ev['time']
+                self.exposureTime = exposureLength(ev, self.current)
+            elif ev['event'] == 'exposure_end':
+                apflog("Exposure of %s finished" % self.target, echo=True)
+                # Exposures ended early by checkClouds have no start by now, and don't calibrate the predictor
+                if self.exposureStart is not None and self.current is not None:
+                    self.APF.exposureFinished(self.current.line, self.exposureStart, ev['time'])
+                self.exposureStart = None
+            elif ev['event'] == 'error':
+                apflog("Robot reported an error while observing %s: %s" % (self.target, ev['line']), level='error', echo=True)
+                # Only a script that exited with a code has ended the exposure
+                if 'code' in ev:
+                    self.exposureStart = None
+
+    def checkClouds(self, running):
+        """ Ends the current exposure early if the guider says clouds mean it can't reach its count threshold. """
+        if not running or self.exposureStart is None:
+            return
+        elapsed = time.time() - self.exposureStart
+        # cloudedOut reads two keywords
+        self.expect(ad.KTL_TIMEOUT)
+        if self.APF.cloudedOut(elapsed, self.exposureTime):
+            apflog("Transparency of %s has collapsed %d s into a %d s exposure. Ending it early." % (self.target, elapsed, self.exposureTime), echo=True)
+            self.expect(0)
+            self.APF.stopExposure()
+            self.exposureStart = None
+
+    def fixedProgress(self):
+        """Returns the number of lines of the fixed list that have been dealt with."""
+        try:
+            return int(self.APF.robot["MASTER_VAR_2"].read(timeout=ad.KTL_TIMEOUT))
+        except ValueError:
+            return int(self.APF.ldone)
+
+    def checkTOO(self):
+        """Queues the targets in TOO.txt, if it exists, then renames it to TOO_done.txt."""
+        if not os.path.exists("TOO.txt"):
+            return
+        n = self.queue.addStarlist("TOO.txt", 'too', obsQueue.TOO)
+        apflog("Found %d target(s) of opportunity in TOO.txt. File will be renamed 'TOO_done.txt'" % n, echo=True)
+        try:
+            os.rename("TOO.txt", "TOO_done.txt")
+        except OSError:
+            apflog("Couldn't rename TOO.txt, removing it from the queue so it isn't observed twice.", echo=True)
+            os.remove("TOO.txt")
+
+    def feedQueue(self):
+        """ Adds work to the queue. TOO.txt always, the fixed list once, and the dynamic scheduler
+        only when there is no fixed list and nothing else is queued. """
+        self.checkTOO()
+        if self.fixedList is not None:
+            if not self.fixedLoaded:
+                self.expect(0)
+                done = self.fixedProgress()
+                n = self.queue.addStarlist(self.fixedList, 'fixed', obsQueue.FIXED, skip=done)
+                apflog("Queued %d target(s) of fixed list %s starting on line %d" % (n, self.fixedList, done), echo=True)
+                self.fixedLoaded = True
+        elif self.queue.peek() is None:
+            self.expect(300)
+            infile = sh.getObs()
+            if infile is None:
+                apflog("Couldn't get a valid target from sh.getObs().",echo=True)
+            else:
+                n = self.queue.addStarlist(infile, 'dynamic', obsQueue.DYNAMIC, lifetime=obsQueue.DYNAMIC_LIFETIME)
+                apflog("Queued %d target(s) from the dynamic scheduler" % n, echo=True)
+
+    def finishCurrent(self):
+        """ Called once the robot has stopped. Records the last observation number, a successful observation
+        in the hit list, and progress through the fixed list, retrying a failed line once. Passes where
+        nothing was handed to the robot leave the files alone. """
+        req = self.current
+        self.current = None
+        if req is None:
+            return
+        self.expect(0)
+        self.APF.updateLastObs()
+        self.expect(0)
+        status = self.APF.robot['SCRIPTOBS_STATUS'].read(timeout=ad.KTL_TIMEOUT)
+        if status == 'Exited/Success':
+            self.APF.hitlist.add(req.line)
+        if req.source != 'fixed':
+            return
+        if status != 'Exited/Success' and req.attempts < 2:
+            apflog("Observation of %s ended with %s. Trying it again." % (req.name, status), echo=True)
+            self.queue.push(req)
+            return
+        self.expect(0)
+        APFLib.write(self.APF.robot["MASTER_VAR_2"], req.index + 1)
+
+    def submit(self, req):
+        """ Hands a single request to the robot. TOO and dynamic targets are checked for observability first,
+        and dynamic targets already observed tonight are dropped. """
+        if req.source == 'dynamic' and self.APF.hitlist.observed(req.name, hitList.nightOf()):
+            apflog("%s from %s was already observed tonight, dropping it." % (req.name, req.source), echo=True)
+            return False
+        with open(ObsFile, 'w') as f:
+            f.write(req.line)
+        obsfile = ObsFile
+        if req.source != 'fixed':
+            obsfile = self.APF.filterStarlist(ObsFile)
+            if obsfile is None:
+                apflog("%s from %s is not currently observable, dropping it." % (req.name, req.source), echo=True)
+                return False
+        sl = starlistFilter.Starlist(obsfile)
+        duration = self.APF.predictStarlist(sl)[2]
+        if len(duration) > 0 and self.APF.closureLikely(float(duration[0])):
+            if not req.held:
+                apflog("Weather is likely to force a close during the %d s exposure of %s. Holding off." % (duration[0], req.name), echo=True)
+                req.held = True
+            self.queue.push(req)
+            return False
+        req.held = False
+        req.attempts += 1
+        self.current = req
+        apflog("Observing %s from %s (priority %d, %d request(s) queued)" % (req.name, req.source, req.priority, len(self.queue)), echo=True)
+        # In test mode observe waits out the exposure
+        self.expect(360)
+        self.APF.observe(obsfile, skip=0)
+        return True
+
+    def checkPreempt(self, running):
+        """Stops the robot if an urgent request is waiting behind a less important one."""
+        self.checkTOO()
+        if not running or self.current is None:
+            return
+        best = self.queue.peek()
+        if best is not None and best.priority >= obsQueue.PREEMPT and best.priority > self.current.priority:
+            apflog("Interrupting %s to observe %s" % (self.current.name, best.name), echo=True)
+            self.expect(1260)
+            self.APF.killRobot(now=False)
+            self.current.attempts -= 1
+            self.queue.push(self.current)
+            self.current = None
 
     def run(self):
-        APF = self.APF
+        self.APF.token = self.token
         apflog("Beginning observing process....",echo=True)                
-        while self.signal:
-            # Check on everything
-            if datetime.now().strftime("%p") == 'AM':
-                rising = True
-            else:
-                rising = False
-            wind_vel = APF.wvel
-            ripd, running = APF.findRobot()
-            el = float(APF.sunel)
-
-            # Check and close for weather
-            if APF.isOpen()[0] and not APF.openOK:
-                closetime = datetime.now()
-                apflog("No longer ok to open.", echo=True)
-                apflog("OPREASON:" + APF.checkapf["OPREASON"].read(), echo=True)
-                apflog("WEATHER:" + APF.checkapf['WEATHER'].read(), echo=True)
-                if running:
-                    APF.killRobot(now=True)
+        while self.signal and not self.token.cancelled:
+            try:
+                self.step()
+            except supervisor.Cancelled:
+                break
+            except SystemExit as e:
+                # The watcher gave up on purpose, don't have it restarted. A failure is handed to the main thread.
+                self.exitMessage = "Watcher exited: %s" % e
+                if e.code not in (None, 0):
+                    self.exitStatus = e.code
+                self.signal = False
+                return
+            except Exception as e:
+                # signal is left set, so the supervisor sees a watcher that died and restarts it
+                apflog("Watcher raised %s, it is exiting:\n%s" % (repr(e), traceback.format_exc()), level='error', echo=True)
+                return
+            # Pace the loop, but wake straight away if cancelled
+            self.token.wait(1)
+            
 
-                APF.close()
-                APF.updateLastObs()
-                
+    def step(self):
+        """One pass of the watcher: checks the conditions and acts on them."""
+        APF = self.APF
+        self.expect(0)
+        # Check on everything
+        if datetime.now().strftime("%p") == 'AM':
+            rising = True
+        else:
+            rising = False
+        wind_vel = APF.wvel
+        self.checkRobotEvents()
+        ripd, running = APF.findRobot()
+        APF.reapRobot()
+        self.expect(0)
+        self.checkClouds(running)
+        el = float(APF.sunel)
+        # Only read again after opening or closing
+        self.expect(0)
+        isopen = APF.isOpen()[0]
+
+        # Check and close for weather
+        if isopen and not APF.openOK:
+            closetime = datetime.now()
+            apflog("No longer ok to open.", echo=True)
+            self.expect(0)
+            apflog("OPREASON:" + APF.checkapf["OPREASON"].read(timeout=ad.KTL_TIMEOUT), echo=True)
+            self.expect(0)
+            apflog("WEATHER:" + APF.checkapf['WEATHER'].read(timeout=ad.KTL_TIMEOUT), echo=True)
+            if running:
+                self.expect(1260)
+                APF.killRobot(now=True)
+
+            self.expect(ad.CLOSE_TIMEOUT + 360)
+            APF.close()
+            APF.updateLastObs()
+            isopen = APF.isOpen()[0]
             
-            # If we are open and the sun rises, closeup
-            if el > -8.9 and not running and rising:
-                apflog("Closing due to the sun.", echo=True)
-                if APF.isOpen()[0]:
-                    msg = "APF is open, closing due to sun elevation = %4.2f" % el
-                else:
-                    msg = "Telescope was already closed when sun got to %4.2f" % el
+        
+        # If we are open and the sun rises, closeup
+        if el > -8.9 and not running and rising:
+            apflog("Closing due to the sun.", echo=True)
+            if isopen:
+                msg = "APF is open, closing due to sun elevation = %4.2f" % el
+            else:
+                msg = "Telescope was already closed when sun got to %4.2f" % el
+            self.expect(ad.CLOSE_TIMEOUT + 360)
+            APF.close()
+            isopen = APF.isOpen()[0]
+            if isopen:
+                apflog("Closeup did not succeed", level='Error', echo=True)
+            APF.updateLastObs()
+            self.exitMessage = msg
+            self.signal = False
+
+
+        # Open at sunset
+        if not isopen and el < -3.2 and el > -8 and APF.openOK and not rising:
+            apflog("Running open at sunset as sunel = %4.2f" % el)
+            self.expect(2*ad.OPEN_TIMEOUT + 660)
+            result = APF.openat(sunset=True)
+            if not result:
+                apflog("After two tries openatsunset hasn't successfully opened. \
+                           Emailing for help and exiting.", level='error', echo=True)
+                self.expect(ad.CLOSE_TIMEOUT + 360)
                 APF.close()
-                if APF.isOpen()[0]:
-                    apflog("Closeup did not succeed", level='Error', echo=True)
-                APF.updateLastObs()
-                self.exitMessage = msg
-                self.stop()
-
-
-            # Open at sunset
-            if not APF.isOpen()[0] and el < -3.2 and el > -8 and APF.openOK and not rising:
-                apflog("Running open at sunset as sunel = %4.2f" % el)
-                result = APF.openat(sunset=True)
-                if not result:
-                    apflog("After two tries openatsunset hasn't successfully opened. \
-                               Emailing for help and exiting.", level='error', echo=True)
-                    APF.close()
-                    sys.exit(1)  
-
-            # If we are closed, and the sun is down, openatnight
-            if not APF.isOpen()[0]  and el < -8.9 and APF.openOK:
-                apflog("Running open at night at sunel =%4.2f" % el)
-                result = APF.openat(sunset=False)
-                if not result:
-                    apflog("After two tried openatnight couldn't succeed. \
-                               Emailing for help and exiting.", level='error', echo=True)
-                    APF.close()
-                    sys.exit(1)
+                sys.exit(1)  
+            isopen = APF.isOpen()[0]
+
+        # If we are closed, and the sun is down, openatnight
+        if not isopen  and el < -8.9 and APF.openOK:
+            apflog("Running open at night at sunel =%4.2f" % el)
+            self.expect(2*ad.OPEN_TIMEOUT + 660)
+            result = APF.openat(sunset=False)
+            if not result:
+                apflog("After two tried openatnight couldn't succeed. \
+                           Emailing for help and exiting.", level='error', echo=True)
+                self.expect(ad.CLOSE_TIMEOUT + 360)
+                APF.close()
+                sys.exit(1)
+            isopen = APF.isOpen()[0]
 
-            
-            # If we are open at night and the robot isn't running
-            # take an obs
-            if APF.isOpen()[0] and not running and el <= -8.9:
-                # Update the last obs file and hitlist if needed
+        
+        # Let urgent targets interrupt whatever the robot is doing
+        if isopen:
+            self.checkPreempt(running)
+
+        # If we are open at night and the robot isn't running
+        # take an obs
+        if isopen and not running and el <= -8.9:
+            # Record the observation the robot just finished, if any
+            self.finishCurrent()
+            self.expect(0)
+            APF.updateWindshield(self.windshield)
+            apflog("Looking for a valid target",echo=True)
+            self.feedQueue()
+            req = self.queue.pop()
+            if req is None and self.fixedList is not None and self.fixedLoaded:
+                # The fixed list has been completely observed so nothing left to do
+                self.expect(ad.CLOSE_TIMEOUT + 360)
+                APF.close()
                 APF.updateLastObs()
-                APF.updateWindshield(self.windshield)
-                apflog("Looking for a valid target",echo=True)
-                tooFound = False
-                try:
-                    f = open("TOO.txt",'r')
-                except IOError:
-                    pass
-                else:
-                    f.close()
-                    apflog("Found a target of opportunity. Observing that.", echo=True)
-                    apflog("After starting Observation file will be renamed 'TOO_done.txt'", echo=True)
-                    APF.observe("TOO.txt")
-                    tooFound = True
-                if self.fixedList is not None and not tooFound:
-                    tot = getTotalLines(self.fixedList)
-                    if apf.ldone == tot:
-                        APF.close()
-                        APF.updateLastObs()
-                        self.exitMessage = "Fixed list is finished. Exiting the watcher."
-                        self.stop()
-                        # The fixed list has been completely observed so nothing left to do
-                    else:
-                        apflog("Found Fixed list %s" % self.fixedList, echo=True)
-                        apflog("Starting fixed list on line %s" % str(apf.ldone), echo=True)
-                        APF.observe(str(self.fixedList), skip=int(apf.ldone))
-                elif not tooFound:
-                    infile = sh.getObs()
-                    if infile is None:
-                        apflog("Couldn't get a valid target from sh.getObs().",echo=True)
-                    else:
-                        # Make sure we don't pass an empty starlist to scriptobs
-                        lines = getTotalLines(infile)
-                        apflog("Observing valid target list with %d line(s)" % (lines),echo=True)
-                        if lines > 0:
-                            APF.observe(infile, skip=0)
-                # Don't let the watcher run over the robot starting up
-                APFTask.waitFor(self.task, True, timeout=5)
-                    
+                self.exitMessage = "Fixed list is finished. Exiting the watcher."
+                self.signal = False
+            elif req is None:
+                apflog("No targets are queued.", echo=True)
+            else:
+                self.submit(req)
+            # Don't let the watcher run over the robot starting up
+            self.token.wait(5)
                 
-            # Keep an eye on the deadman timer if we are open 
-            if APF.isOpen()[0] and APF.dmtime <= 120:
-                APF.DMReset()
             
+        # Keep an eye on the deadman timer if we are open 
+        if isopen and APF.dmtime <= 120:
+            self.expect(0)
+            APF.DMReset()
+
+    def expect(self, seconds):
+        """ Tells the supervisor the next call may legitimately block for up to this many seconds.
+        expect(0) just beats the heartbeat. Every keyword read is made with a timeout of ad.KTL_TIMEOUT,
+        shorter than supervisor.STALL, and the heartbeat is beaten before each one. """
+        self.heartbeat = time.time() + seconds
 
     def stop(self):
+        """Asks the watcher to exit, interrupting any wait or robot script it is running."""
         self.signal = False
-        threading.Thread._Thread__stop(self)
+        self.token.cancel()
+
+
+def restartMaster(old):
+    """Returns a new watcher that carries on with the state of a stalled one."""
+    new = Master(old.APF, old.user)
+    for attr in ['task', 'fixedList', 'fixedLoaded', 'windshield', 'robotlog', 'queue', 'current', 'target', 'exposureStart', 'exposureTime']:
+        setattr(new, attr, getattr(old, attr))
+    return new
 
 
 if __name__ == '__main__':
@@ -267,10 +512,19 @@ if __name__ == '__main__':
     apflog("Master initiallizing APF monitors.", echo=True)
 
     # Aquire an instance of the APF class, which holds wrapper functions for controlling the telescope
-    apf = ad.APF(task=parent, test=debug)
+    apf = ad.APF(task=parent, test=debug, datadir=ad.MasterDir)
     APFTask.waitFor(parent, True, timeout=5)
     print "Successfully initiallized APF class"
 
+    # Writing anything but 0 or off to MASTER_VAR_3 profiles the running master
+    profile = profiler.ProfileSwitch(os.path.join(ad.MasterDir, 'profiles'))
+    profile.watch(apf.robot["MASTER_VAR_3"])
+    atexit.register(profile.stop)
+
+    # Keep an eye on the memory, file descriptors and child processes of the master through the night
+    resources = resourceWatch.ResourceWatchdog(rollup=apf.rollup, trace=opt.tracemalloc)
+    resources.start()
+
     # Check to see if the instrument has been released
     if not debug:
         if apf.checkapf['INSTRELE'].read().strip().lower() != 'yes':
@@ -297,6 +551,7 @@ if __name__ == '__main__':
     # Regardless of phase, if a name, obsnum, or reset was commanded, make sure we perform these operations.
     if opt.restart:
         APFLib.write(apf.robot["SCRIPTOBS_LINES_DONE"], 0)
+        APFLib.write(apf.robot["MASTER_VAR_2"], 0)
     if str(phase).strip() != "ObsInfo":
         if opt.obsnum:
             APFLib.write(apf.ucam["OBSNUM"], int(opt.obsnum))
@@ -305,15 +560,16 @@ if __name__ == '__main__':
     # Goes through 5 steps:
     # 1) Set the observer information
     # 2) Run focuscube
-    # 3) Run calibrate ucsc pre
+    # 3) Run calibrate ucsc pre, while switching the TEQ to night mode
     # 4) Start the main watcher
     # 5) Run calibrate ucsc post
     # Specifying a phase jumps straight to that point, and continues from there.
-
+    # Steps 1-3 run as a graph, so steps that don't depend on each other (like preparing
+    # the fixed list) run at the same time. Each finished phase is recorded in the phase keyword.
 
     # 1) Setting the observer information.
     # Sets the Observation number, observer name, file name, and file directory
-    if "ObsInfo" == str(phase).strip():
+    def obsInfo():
         apflog("Setting the task step to 0")
         APFTask.step(parent,0)
         if opt.obsnum == None:
@@ -343,30 +599,62 @@ if __name__ == '__main__':
         apflog("Using %s for obs number." % repr(obsNum),echo=True)
         apflog("Setting Observer Information", echo=True)
         apf.setObserverInfo(num=obsNum, name=opt.name)
-        apflog("Setting ObsInfo finished. Setting phase to Focus.")
-        APFTask.phase(parent, "Focus")
-        apflog("Phase is now %s" % phase)
+        apflog("Setting ObsInfo finished.")
+        return True
 
-    # Run autofocus cube
-    if "Focus" == str(phase).strip():
+    # 2) Run autofocus cube
+    def focus():
         apflog("Starting focuscube script.", level='Info', echo=True)
-        result = apf.focus(user='ucsc')
-        if not result:
-            apflog("Focuscube has failed. Observer is exiting.",level='error',echo=True)
-            sys.exit(1)
-        apflog("Focus has finished. Setting phase to Cal-Pre")
-        APFTask.phase(parent, "Cal-Pre")
-        apflog("Phase now %s" % phase)
+        return apf.focus(user='ucsc')
 
-    # Run pre calibrations
-    if 'Cal-Pre' == str(phase).strip():
+    # 3) Run pre calibrations
+    def calPre():
         apflog("Starting calibrate pre script.", level='Info', echo=True)
-        result = apf.calibrate(script = opt.calibrate, time = 'pre')
-        if not result:
-            apflog("Calibrate Pre has failed. Observer is exiting.",level='error',echo=True)
-            sys.exit(2)
-        apflog("Calibrate Pre has finished. Setting phase to Watching.")
-        APFTask.phase(parent, "Watching")
+        return apf.calibrate(script = opt.calibrate, time = 'pre')
+
+    # A TEQ that won't switch doesn't end the night, observe sets it again before the first observation
+    def teqNight():
+        try:
+            apf.setTeqMode('Night')
+        except RuntimeError as e:
+            apflog("Couldn't set the TEQ to Night mode: %s. Will try again when observing starts." % e, level='warn', echo=True)
+        return True
+
+    # Prepare the fixed list for the watcher
+    def fixedList():
+        if opt.fixed == None:
+            return True
+        apflog("Fixed list arg %s" % opt.fixed,echo=True)
+        lastList = apf.robot["MASTER_VAR_1"].read()
+        # This resets lines done if this is a new target list
+        if opt.fixed != lastList:
+            APFLib.write(apf.robot["SCRIPTOBS_LINES_DONE"], 0)
+            APFLib.write(apf.robot["MASTER_VAR_2"], 0)
+            APFLib.write(apf.robot["MASTER_VAR_1"], opt.fixed)
+        if opt.order == 'slew':
+            # Lines done counts lines of the reordered list, so only reorder a new list
+            root, ext = os.path.splitext(opt.fixed)
+            ordered = root + "_slew" + ext
+            if opt.fixed != lastList or opt.restart or not os.path.exists(ordered):
+                ordered = apf.orderStarlist(opt.fixed)
+            opt.fixed = ordered
+        return True
+
+    setup = phaseGraph.PhaseGraph(parent, possible_phases)
+    setup.add("ObsInfo", obsInfo, phase="ObsInfo", checkpoint="Focus")
+    setup.add("Focus", focus, deps=["ObsInfo"], phase="Focus", checkpoint="Cal-Pre")
+    setup.add("Cal-Pre", calPre, deps=["Focus"], phase="Cal-Pre")
+    setup.add("TEQ-Night", teqNight, deps=["Focus"], phase="Cal-Pre")
+    setup.add("FixedList", fixedList, phase="Watching")
+    setup.add("Ready", lambda: True, deps=["Cal-Pre", "TEQ-Night"], phase="Cal-Pre", checkpoint="Watching")
+
+    if str(phase).strip() in possible_phases[:possible_phases.index("Watching")+1]:
+        failed = setup.run(start=str(phase).strip())
+        if failed is not None:
+            apflog("%s has failed. Observer is exiting." % failed.name, level='error', echo=True)
+            if failed.name == "Cal-Pre":
+                sys.exit(2)
+            sys.exit(1)
         apflog("Phase is now %s" % phase)
 
 
@@ -374,21 +662,19 @@ if __name__ == '__main__':
     master = Master(apf)
     if 'Watching' == str(phase).strip():
         apflog("Starting the main watcher." ,echo=True)
-    
-        if opt.fixed != None:
-            apflog("Fixed list arg %s" % opt.fixed,echo=True)
-            lastList = apf.robot["MASTER_VAR_1"].read()
-            # This resets lines done if this is a new target list
-            if opt.fixed != lastList:
-                APFLib.write(apf.robot["SCRIPTOBS_LINES_DONE"], 0)
-                APFLib.write(apf.robot["MASTER_VAR_1"], opt.fixed)
         master.fixedList = opt.fixed
         master.task = parent
         master.windsheild = opt.windshield
+        master.robotlog = robotLog.RobotLogWatcher(recorder=robotLog.ExposureRecorder(os.path.join(ad.MasterDir, robotLog.ExposureFile)))
+        master.robotlog.start()
         master.start()
     else:
         master.signal = False
 
+    # Supervise the watcher. A watcher whose heartbeat stalls is cancelled and restarted.
+    watch = supervisor.Supervisor(master, restartMaster)
+    wedged = False
+    lastPrint = 0
     while master.signal:
         # Master is running, check for keyboard interupt
         try:
@@ -399,23 +685,43 @@ if __name__ == '__main__':
             #  Log that we force a close so we can look into why this happened.
             if currTime.hour == 9:
                 # Its 9 AM. Lets closeup
-                master.stop()
+                watch.stop()
                 apflog("Master was still running at 9AM. It was stopped and post calibrations will be attempted.", level='Warn')
                 break
 
-            if debug:
+            if not watch.check():
+                wedged = True
+                break
+            master = watch.worker
+            # Close the telemetry buckets of keywords that have gone quiet
+            apf.rollup.flush()
+
+            if debug and time.time() - lastPrint > 30:
+                lastPrint = time.time()
                 print 'Master is running.'
                 print str(apf)
-            APFTask.waitFor(parent, True, timeout=30)
+            APFTask.waitFor(parent, True, timeout=1)
         except KeyboardInterrupt:
             apflog("Watcher.py killed by user.")
-            master.stop()
+            watch.stop()
             sys.exit("Master was killed by user")
         except:
             apflog("Watcher killed by unknown.")
-            master.stop()
+            watch.stop()
             sys.exit("Master died, not by user.")
 
+    if wedged:
+        apflog("Master watcher is wedged and could not be recovered. Exiting so it can be restarted.", level='error', echo=True)
+        sys.exit("Master watcher wedged.")
+
+    # A watcher that couldn't open or close has already tried to close up, don't carry on into the morning
+    if master.exitStatus is not None:
+        apflog("%s. Observer is exiting." % master.exitMessage, level='error', echo=True)
+        sys.exit(master.exitStatus)
+
+    # The night's cancellation token is done with, let the morning commands run to completion
+    apf.token = None
+
     # Check if the master left us an exit message.
     # If so, something strange likely happened so log it.
     try:
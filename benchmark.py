@@ -0,0 +1,315 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# benchmark.py
+# Offline benchmarks and callback stress test for APFControl and Heimdallr.
+# The ktl services, APF, APFTask, apflog and schedulerHelper modules are replaced by in-memory stand-ins,
+# so this runs on any machine with numpy. Results are appended to a JSON lines history, and compared
+# against the recent runs to catch regressions before deployment.
+#
+# ./benchmark.py                  run the benchmarks
+# ./benchmark.py --stress         also fire keyword updates at 10-1000 Hz and measure callback latency
+# ./benchmark.py --check          exit with status 1 if anything is slower than the recent history
+
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import Queue
+from timeit import default_timer as timer
+
+HistoryFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_history.jsonl')
+
+# A result this much slower than the median of the recent runs is a regression
+REGRESSION = 1.25
+HISTORY_RUNS = 5
+
+
+# Keyword values seen by the stand-in services. Everything else reads as 0.
+VALUES = {
+    'SUNEL': -20.0, 'AEL': 45.0, 'AAZ': 180.0, 'AAFOCUS': 0.1, 'RSCURPOS': 0.0, 'FSCURPOS': 0.0,
+    'OPEN_OK': True, 'DMTIME': 600, 'WX_BYSTN': 'ok', 'MOVE_PERM': True, 'CHK_CLOSE': False,
+    'OPREASON': 'All conditions OK', 'WEATHER': 'clear', 'WHATSOPN': 'DomeShutter MirrorCover', 'INSTRELE': 'yes',
+    'AVGWSPEED': 5.0, 'AVGWDIR': 90.0,
+    'SCRIPTOBS_VMAG': 8.0, 'SCRIPTOBS_LINES_DONE': 0, 'SCRIPTOBS_PID': -1, 'SCRIPTOBS_STATUS': 'Exited/Success',
+    'SCRIPTOBS_WINDSHIELD': 'Disable', 'SCRIPTOBS_AUTOFOC': 'robot_autofocus_enable', 'MASTER_VAR_1': '', 'MASTER_VAR_2': 0,
+    'MODE': 'Night', 'COUNTS': 1000.0, 'COUNTRATE': 5000.0, 'XPOSE_THRESH': 1e6, 'FWHM': 12.0, 'DECKERNAM': 'W',
+    'OBSNUM': 10000, 'OBSERVER': 'Robot', 'OUTDIR': '/data/apf/', 'OUTFILE': 'ucsc', 'EVENT_STR': 'ControllerReady',
+}
+
+
+class Keyword:
+    """Stand-in for ktl.Keyword, backed by VALUES."""
+
+    def __init__(self, service, name):
+        self.service = service
+        self.name = name
+        self.callbacks = []
+
+    @property
+    def binary(self):
+        return VALUES.get(self.name.upper(), 0)
+
+    def read(self, binary=False, timeout=None):
+        if binary:
+            return self.binary
+        return str(self.binary)
+
+    # Signatures follow ktl, so a misspelled argument fails here as it would on the telescope
+    def write(self, value, wait=True, timeout=None):
+        VALUES[self.name.upper()] = value
+
+    def monitor(self, start=True, prime=True, wait=True):
+        # Like ktl, a newly monitored keyword delivers its current value to the callbacks
+        self.poll()
+
+    def callback(self, func):
+        self.callbacks.append(func)
+
+    def poll(self):
+        for func in self.callbacks:
+            func(self)
+
+    def waitfor(self, expression, timeout=None):
+        return True
+
+    def __float__(self):
+        return float(self.binary)
+
+    def __int__(self):
+        return int(self.binary)
+
+    def __str__(self):
+        return str(self.binary)
+
+    def __nonzero__(self):
+        return bool(self.binary)
+
+
+class Service:
+    """Stand-in for ktl.Service."""
+
+    def __init__(self, name):
+        self.name = name
+        self.keywords = dict()
+
+    def __getitem__(self, name):
+        if name.upper() not in self.keywords:
+            self.keywords[name.upper()] = Keyword(self, name)
+        return self.keywords[name.upper()]
+
+    __call__ = __getitem__
+
+
+def installStubs(workdir):
+    """Puts the stand-in modules in sys.modules, so APFControl and Heimdallr import without the telescope."""
+    ktl = types.ModuleType('ktl')
+    ktl.Service = Service
+    sys.modules['ktl'] = ktl
+
+    apflib = types.ModuleType('APF')
+    apflib.write = lambda kw, value, **kwargs: kw.write(value)
+    apflib.waitFor = lambda *args, **kwargs: True
+    sys.modules['APF'] = apflib
+
+    task = types.ModuleType('APFTask')
+    for name in ['establish', 'set', 'phase', 'step']:
+        setattr(task, name, lambda *args, **kwargs: None)
+    task.waitFor = lambda *args, **kwargs: True
+    sys.modules['APFTask'] = task
+
+    log = types.ModuleType('apflog')
+    log.apflog = lambda msg, level='info', echo=False: None
+    log.__all__ = ['apflog']
+    sys.modules['apflog'] = log
+
+    sched = types.ModuleType('schedulerHelper')
+    sched.getObs = lambda: os.path.join(workdir, 'sched_obs.txt')
+    sched.cleanup = lambda: None
+    sys.modules['schedulerHelper'] = sched
+
+
+def starline(i):
+    return "HD%d %02d %02d %04.1f %+03d %02d %02d vmag=%.1f texp=600 expcount=1e9 I2=Y lamp=none uth=0 utm=0 do=\n" % (
+        i, random.randint(0, 23), random.randint(0, 59), random.uniform(0, 59),
+        random.randint(-20, 80), random.randint(0, 59), random.randint(0, 59), random.uniform(3, 11))
+
+def makeFiles(workdir, listlines, logsheets):
+    random.seed(1)
+    with open(os.path.join(workdir, 'big_list.txt'), 'w') as f:
+        f.write("# Fixed list\n")
+        for i in range(listlines):
+            f.write(starline(i))
+    with open(os.path.join(workdir, 'sched_obs.txt'), 'w') as f:
+        f.write(starline(0))
+    with open(os.path.join(workdir, 'lastObs.txt'), 'w') as f:
+        f.write("10000\n")
+    butler = os.path.join(workdir, 'butler')
+    os.mkdir(butler)
+    for i in range(logsheets):
+        with open(os.path.join(butler, 'logsheet_%05d' % i), 'w') as f:
+            for j in range(200):
+                f.write("%d HD%d 600 comment\n" % (10000 + j, j))
+    return butler
+
+
+def bench(func, number, repeat=3):
+    """Best time per call over repeat runs of number calls, in seconds."""
+    best = None
+    for _ in range(repeat):
+        t0 = timer()
+        for _ in xrange(number):
+            func()
+        t = (timer() - t0) / number
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def runBenchmarks(opt, ad, hd):
+    apf = ad.APF(task='example', test=True)
+    results = dict()
+
+    results['countmon'] = bench(lambda: ad.countmon(ad.APF.countrate), opt.number)
+    results['fwhmmon']  = bench(lambda: ad.fwhmmon(ad.APF.fwhm), opt.number)
+    results['windmon']  = bench(lambda: ad.windmon(ad.APF.wx), opt.number)
+    results['APF.__str__'] = bench(lambda: str(apf), max(opt.number // 10, 1))
+
+    biglist = os.path.join(opt.workdir, 'big_list.txt')
+    results['getTotalLines'] = bench(lambda: hd.getTotalLines(biglist), 5)
+    results['findObsNum'] = bench(lambda: hd.findObsNum(butlerPath=opt.butler), 5)
+    results['updateLastObs'] = bench(apf.updateLastObs, 5)
+
+    master = hd.Master(apf)
+    master.task = 'example'
+    # A cancelled token makes the watcher's pauses return immediately, so only the decision itself is timed
+    master.token.cancel()
+    results['Master.step'] = bench(master.step, 20)
+    return results
+
+
+def stress(ad, rate, duration):
+    """ Fires keyword updates at rate Hz for duration seconds through a single dispatch thread, like the ktl
+    callback thread. Returns the 50th and 99th percentile latency from update to callback done, and the largest backlog. """
+    callbacks = [(ad.countmon, ad.APF.countrate), (ad.fwhmmon, ad.APF.fwhm), (ad.windmon, ad.APF.wx),
+                 (ad.okmon, ad.APF.ok2open), (ad.slewmon, ad.APF.aaz)]
+    q = Queue.Queue()
+    latency = []
+    backlog = [0]
+
+    def dispatch():
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            fired, (func, kw) = item
+            func(kw)
+            latency.append(timer() - fired)
+
+    d = threading.Thread(target=dispatch)
+    d.start()
+    period = 1.0 / rate
+    start = timer()
+    n = 0
+    while timer() - start < duration:
+        q.put((timer(), callbacks[n % len(callbacks)]))
+        n += 1
+        backlog[0] = max(backlog[0], q.qsize())
+        # Keep to the schedule rather than sleeping a fixed period, so slow callbacks show up as backlog
+        wait = start + n * period - timer()
+        if wait > 0:
+            time.sleep(wait)
+    q.put(None)
+    d.join()
+    latency.sort()
+    return latency[len(latency) // 2], latency[int(len(latency) * 0.99)], backlog[0]
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def compare(results, history):
+    """Returns (name, now, median of recent runs) for every result that has regressed."""
+    slow = []
+    for name, value in sorted(results.items()):
+        past = sorted(h['results'][name] for h in history[-HISTORY_RUNS:] if name in h['results'])
+        if not past or name.endswith('_backlog'):
+            continue
+        med = past[len(past) // 2]
+        if med > 0 and value > REGRESSION * med:
+            slow.append((name, value, med))
+    return slow
+
+
+def args():
+    parser = argparse.ArgumentParser(description="Benchmark APFControl callbacks and Heimdallr file handling offline.")
+    parser.add_argument('-n', '--number', type=int, default=2000, help="Calls per timing of the keyword callbacks.")
+    parser.add_argument('--lines', type=int, default=100000, help="Lines in the large star list.")
+    parser.add_argument('--logsheets', type=int, default=5000, help="Files in the logsheet directory.")
+    parser.add_argument('--stress', action='store_true', help="Also run the keyword update stress test.")
+    parser.add_argument('--rates', default='10,100,1000', help="Comma separated update rates (Hz) for the stress test.")
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds to run each stress rate.")
+    parser.add_argument('--history', default=HistoryFile, help="JSON lines file the results are appended to.")
+    parser.add_argument('--check', action='store_true', help="Exit with status 1 if there are regressions.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = args()
+    here = os.path.dirname(os.path.abspath(__file__))
+    opt.workdir = tempfile.mkdtemp(prefix='apfbench')
+    try:
+        installStubs(opt.workdir)
+        opt.butler = makeFiles(opt.workdir, opt.lines, opt.logsheets)
+        os.chdir(opt.workdir)
+        sys.path.insert(0, here)
+        import APFControl as ad
+        ad.MasterDir = opt.workdir
+        import Heimdallr as hd
+        # The master's exit hook reports a status, but nothing was started
+        hd.success = True
+
+        results = runBenchmarks(opt, ad, hd)
+        if opt.stress:
+            for rate in [float(r) for r in opt.rates.split(',')]:
+                p50, p99, backlog = stress(ad, rate, opt.duration)
+                results['stress_%gHz_p50' % rate] = p50
+                results['stress_%gHz_p99' % rate] = p99
+                results['stress_%gHz_backlog' % rate] = backlog
+    finally:
+        os.chdir(here)
+        shutil.rmtree(opt.workdir, ignore_errors=True)
+
+    history = []
+    try:
+        with open(opt.history, 'r') as f:
+            history = [json.loads(l) for l in f if l.strip()]
+    except IOError:
+        pass
+
+    for name, value in sorted(results.items()):
+        if name.endswith('_backlog'):
+            print "%-28s %10d" % (name, value)
+        else:
+            print "%-28s %10.1f us" % (name, value * 1e6)
+
+    slow = compare(results, history)
+    for name, value, med in slow:
+        print "REGRESSION %s: %.1f us, recent median %.1f us" % (name, value * 1e6, med * 1e6)
+
+    rec = {'time': time.strftime("%Y-%m-%dT%H:%M:%S"), 'commit': gitRevision(), 'host': socket.gethostname(),
+           'python': sys.version.split()[0], 'results': results}
+    with open(opt.history, 'a') as f:
+        f.write(json.dumps(rec, sort_keys=True) + '\n')
+
+    if opt.check and slow:
+        sys.exit(1)
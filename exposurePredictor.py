@@ -0,0 +1,136 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# exposurePredictor.py
+# Predicts how long exposures will really take given the recent transparency and seeing.
+
+import math
+import time
+from collections import deque
+
+import numpy as np
+
+# Guider zero point and decker scaling, as used by countmon to get the expected count rate
+m1 = 22.8
+deckscale = {'M': 1.0, 'W':1.0, 'N': 3.0, 'B': 0.5, 'S':2.0, 'P':1.0}
+
+# Approximate slit widths in arcsec, used for the slit loss due to seeing
+slitwidth = {'M': 1.0, 'W': 1.0, 'N': 0.5, 'B': 2.0, 'S': 0.75, 'P': 1.0}
+
+# Exposure meter counts per guider count at the reference seeing, clear skies.
+# This is only a starting guess. Until it has been fitted from MIN_SAMPLES completed exposures, see addExposure(),
+# predictions are simply texp, the longest an exposure can take.
+EXPMETER_RATIO = 1.0
+REF_SEEING = 1.5
+MIN_SAMPLES = 5
+MAX_SAMPLES = 200
+# An exposure that ends before this fraction of texp stopped on its exposure meter count
+METER_FRACTION = 0.95
+
+# Seconds of slowdown and seeing history used for a prediction
+WINDOW = 1800.
+
+
+def slitfraction(seeing, width):
+    """Fraction of a Gaussian star of the given FWHM that passes through a slit of the given width."""
+    sigma = np.maximum(np.asarray(seeing, dtype=float), 0.1) / 2.3548
+    erf = np.vectorize(math.erf)
+    return erf(width / (2. * math.sqrt(2.) * sigma))
+
+
+class ExposurePredictor:
+    """ Estimates exposure durations from the star list vmag, texp and expcount values.
+    An exposure ends when the exposure meter reaches expcount or when texp runs out. The exposure meter
+    rate is scaled from the guider rate model by the measured transparency (1/slowdown) and the slit loss
+    for the measured seeing. The 16th to 84th percentile range of the recent history gives the uncertainty. """
+
+    def __init__(self, window=WINDOW, ratio=None, path=None):
+        self.window = window
+        self.fitted = ratio is not None
+        self.ratio = EXPMETER_RATIO if ratio is None else ratio
+        self.path = path
+        self.samples = deque(maxlen=MAX_SAMPLES)
+        if path is not None:
+            try:
+                with open(path, 'r') as f:
+                    for line in f:
+                        p = line.split()
+                        try:
+                            self.samples.append((float(p[0]), float(p[1]), float(p[2]), p[3], float(p[4]), float(p[5])))
+                        except (IndexError, ValueError):
+                            continue
+            except IOError:
+                pass
+            self.refit()
+
+    def _recent(self, hist, default, now):
+        vals = [v for t, v in hist if now - t <= self.window]
+        if len(vals) == 0:
+            return np.array([default], dtype=float)
+        return np.array(vals, dtype=float)
+
+    def rate(self, vmag, decker):
+        """Exposure meter count rate, per second, in clear skies at the reference seeing."""
+        vmag = np.asarray(vmag, dtype=float)
+        rate = 10**((m1 - vmag)/2.5) / deckscale.get(decker, 1.0)
+        return self.ratio * rate / slitfraction(REF_SEEING, slitwidth.get(decker, 1.0))
+
+    def predict(self, vmag, texp, expcount, decker, speeds, seeings, now=None):
+        """ Returns the median, low and high estimated exposure time in seconds for each target.
+        speeds and seeings are sequences of (unix time, value) pairs, speed being 1/slowdown. """
+        if now is None:
+            now = time.time()
+        vmag = np.asarray(vmag, dtype=float)
+        texp = np.asarray(texp, dtype=float)
+        expcount = np.asarray(expcount, dtype=float)
+
+        sp = np.percentile(self._recent(speeds, 1.0, now), [84, 50, 16])
+        se = np.percentile(self._recent(seeings, REF_SEEING, now), [16, 50, 84])
+        width = slitwidth.get(decker, 1.0)
+        base = self.rate(vmag, decker)
+
+        out = []
+        for s, fw in zip(sp, se):
+            rate = base * max(s, 1e-3) * slitfraction(fw, width)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = expcount / rate
+            # No exposure meter limit means the exposure runs for texp
+            t = np.where(np.isfinite(t) & (t > 0), t, texp)
+            out.append(np.where(np.isfinite(texp), np.minimum(t, texp), t))
+        if not self.fitted:
+            out = [np.where(np.isfinite(texp), texp, t) for t in out]
+        return out[1], out[0], out[2]
+
+    def implied(self, vmag, expcount, duration, decker, speed, seeing):
+        """The exposure meter ratio implied by exposures that ended on their exposure meter count."""
+        vmag = np.asarray(vmag, dtype=float)
+        model = 10**((m1 - vmag)/2.5) / deckscale.get(decker, 1.0) * np.asarray(speed, dtype=float)
+        model *= slitfraction(seeing, slitwidth.get(decker, 1.0)) / slitfraction(REF_SEEING, slitwidth.get(decker, 1.0))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.asarray(expcount, dtype=float) / np.asarray(duration, dtype=float) / model
+
+    def refit(self):
+        """Refits the ratio from the stored exposures once there are enough of them."""
+        if len(self.samples) < MIN_SAMPLES:
+            return self.ratio
+        implied = np.array([self.implied(*s) for s in self.samples], dtype=float)
+        implied = implied[np.isfinite(implied) & (implied > 0)]
+        if len(implied) >= MIN_SAMPLES:
+            self.ratio = float(np.median(implied))
+            self.fitted = True
+        return self.ratio
+
+    def addExposure(self, vmag, expcount, texp, duration, decker, speed, seeing):
+        """ Adds a completed exposure, with the median speed and seeing measured during it, and refits the ratio.
+        Exposures that ran out their texp say nothing about the exposure meter rate and are ignored. """
+        if not (np.isfinite(vmag) and np.isfinite(expcount) and duration > 0):
+            return self.ratio
+        if np.isfinite(texp) and duration >= METER_FRACTION * texp:
+            return self.ratio
+        sample = (float(vmag), float(expcount), float(duration), decker, float(speed), float(seeing))
+        self.samples.append(sample)
+        if self.path is not None:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write("%.2f %.0f %.1f %s %.3f %.2f\n" % sample)
+            except IOError:
+                pass
+        return self.refit()
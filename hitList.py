@@ -0,0 +1,145 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# hitList.py
+# Indexed, append-only store of completed observations.
+# Replaces re-reading and re-parsing the plain text hit_list to find what has been observed.
+
+import os
+from datetime import datetime, timedelta
+
+from apflog import *
+
+RecordFile = '/u/rjhanson/master/hit_list.idx'
+TextFile   = '/u/rjhanson/master/hit_list'
+
+
+def nightOf(when=None):
+    """Returns the night an observation belongs to as a YYYYMMDD string. Mornings count as the previous night."""
+    if when is None:
+        when = datetime.now()
+    return (when - timedelta(hours=12)).strftime("%Y%m%d")
+
+def targetName(line):
+    """Returns the target name of a star list line, or None for blank and comment lines."""
+    line = line.strip()
+    if line == '' or line[0] == '#':
+        return None
+    return line.split()[0]
+
+
+class HitList:
+    """ Append friendly store of observation records keyed by target name and night.
+    Records are kept in a tab separated file, one per line: night, name, timestamp, star list line.
+    An in memory index gives constant time membership tests and per target counts. With no path the records
+    are only kept in memory. """
+
+    def __init__(self, path=RecordFile, textpath=TextFile):
+        self.path = path
+        self.textpath = textpath
+        self.observations = set()
+        self.counts = dict()
+        self.offset = 0
+
+        if self.path is not None and not os.path.exists(self.path) and self.textpath is not None and os.path.exists(self.textpath):
+            self.importText(self.textpath)
+        self.refresh()
+
+    def __contains__(self, name):
+        return name in self.counts
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def _index(self, night, name):
+        self.observations.add((name, night))
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def refresh(self):
+        """Reads only the records appended to the store since the last refresh."""
+        if self.path is None:
+            return
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return
+        f.seek(self.offset)
+        while True:
+            rec = f.readline()
+            # Stop at a partially written record, it will be picked up next time
+            if not rec.endswith('\n'):
+                break
+            self.offset += len(rec)
+            fields = rec.rstrip('\n').split('\t', 3)
+            if len(fields) == 4:
+                self._index(fields[0], fields[1])
+        f.close()
+
+    def add(self, line, when=None):
+        """Records an observed star list line. Also appends it to the text hit_list for the scheduler."""
+        return self.extend([line], when) > 0
+
+    def extend(self, lines, when=None):
+        """Records several observed star list lines at once, returning how many were recorded."""
+        if when is None:
+            when = datetime.now()
+        night = nightOf(when)
+        stamp = when.strftime("%Y-%m-%dT%H:%M:%S")
+        recs = []
+        text = []
+        names = []
+        for line in lines:
+            name = targetName(line)
+            if name is None:
+                continue
+            line = line.strip()
+            recs.append("%s\t%s\t%s\t%s\n" % (night, name, stamp, line))
+            text.append(line + '\n')
+            names.append(name)
+        if not recs:
+            return 0
+
+        # Pick up any records written by another process before we append our own
+        self.refresh()
+        if self.path is not None:
+            data = ''.join(recs)
+            with open(self.path, 'a') as f:
+                f.write(data)
+            self.offset += len(data)
+        for name in names:
+            self._index(night, name)
+
+        if self.textpath is not None:
+            with open(self.textpath, 'a') as o:
+                o.write(''.join(text))
+        return len(recs)
+
+    def observed(self, name, night=None):
+        """ Returns True if the target was observed on the given night, or ever if night is None.
+        Records imported from an old text hit_list have no night, so only count for the latter. """
+        if night is None:
+            return name in self.counts
+        return (name, night) in self.observations
+
+    def count(self, name):
+        """Returns the number of recorded observations of the target."""
+        return self.counts.get(name, 0)
+
+    def importText(self, textpath):
+        """Seeds the store from an old style text hit_list. The night of those records is unknown."""
+        apflog("Building indexed hit list %s from %s" % (self.path, textpath))
+        with open(textpath, 'r') as t:
+            with open(self.path, 'a') as f:
+                for line in t:
+                    name = targetName(line)
+                    if name is not None:
+                        f.write("\t%s\t\t%s\n" % (name, line.strip()))
+
+    def export(self, textpath, night=None):
+        """Writes the star list lines of the store, optionally limited to one night, as a text hit_list."""
+        with open(self.path, 'r') as f:
+            with open(textpath, 'w') as o:
+                for rec in f:
+                    fields = rec.rstrip('\n').split('\t', 3)
+                    if len(fields) != 4:
+                        continue
+                    if night is None or fields[0] == night:
+                        o.write(fields[3] + '\n')
@@ -0,0 +1,358 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# logAnalytics.py
+# Summarizes the archive of nightly robot.log and apflog files, night by night and season by season.
+
+import os
+import re
+import sys
+import glob
+import gzip
+import time
+import argparse
+import multiprocessing
+from datetime import datetime
+
+import numpy as np
+
+import robotLog
+from hitList import nightOf
+
+# Per night columns of the summary, all counts or seconds
+COLUMNS = ['opens', 'open_failures', 'closes', 'close_weather', 'close_sun', 'close_other', 'open_time',
+           'robot_starts', 'robot_stops', 'robot_kills', 'cal_count', 'cal_time', 'failed_scripts',
+           'exposures', 'exposure_time', 'exposures_interrupted', 'exposures_error']
+
+# Lines of the master log and what they mean. The first match wins.
+APF_PATTERNS = [
+    ('open',         re.compile(r'Running open at (?P<kind>sunset|night)')),
+    ('open_failed',  re.compile(r'openup attempt (?:also )?(?:has )?failed\. Exit code =? ?(?P<code>-?\d+)')),
+    ('close',        re.compile(r'Running closeup script')),
+    ('reason',       re.compile(r'(?P<reason>No longer ok to open|Closing due to the sun|Fixed list is finished|still running at 9AM|Too windy)')),
+    ('opreason',     re.compile(r'OPREASON:\s*(?P<reason>.*)')),
+    ('robot_start',  re.compile(r'Starting robot\.csh')),
+    ('robot_stop',   re.compile(r'robot\.csh \(pid \d+\) exited with code (?P<code>-?\d+)')),
+    ('robot_kill',   re.compile(r'Killing Robot\.')),
+    ('finished',     re.compile(r"Command finished with exit code (?P<code>-?\d+) after (?P<secs>\d+) s: '?(?P<cmd>[^']*)'?")),
+    # Older logs only have these for the scripts the master runs
+    ('exec',         re.compile(r"Executing Command: '?(?P<cmd>[^']*)'?")),
+    ('cal_start',    re.compile(r'Running calibrate ')),
+    ('script_failed', re.compile(r'(?P<script>Calibrate|Focuscube|Closeup)\b.*?failed with (?:return |exit )?code (?P<code>-?\d+)')),
+]
+
+# Scripts named by the failure lines of older logs, as named by the command
+SCRIPTS = {'Calibrate': 'calibrate', 'Focuscube': 'auto_focuscube.sh', 'Closeup': 'closeup'}
+OPEN_SCRIPTS = ['openatsunset', 'openatnight']
+
+# Lines the other setup steps log while calibrate runs
+PARALLEL = re.compile(r'Setting TEQMode|Setup step|Fixed list arg|Reordered ')
+
+# Timestamps at the start of a master log line: ISO, or syslog style without a year
+ISO_STAMP = re.compile(r'^\s*\[?(?P<stamp>\d{4}[-/]\d{2}[-/]\d{2}[ T]\d{2}:\d{2}:\d{2})')
+SYSLOG_STAMP = re.compile(r'^\s*(?P<stamp>[A-Z][a-z]{2} +\d{1,2} \d{2}:\d{2}:\d{2})')
+
+# Closes are attributed to the last reason logged within this many seconds before them
+REASON_WINDOW = 900.
+
+
+def season(night):
+    """The observing semester of a YYYYMMDD night: A runs February to July, B August to January."""
+    year, month = int(night[:4]), int(night[4:6])
+    if month == 1:
+        return "%dB" % (year - 1)
+    if month <= 7:
+        return "%dA" % year
+    return "%dB" % year
+
+MONTHS = dict((m, i + 1) for i, m in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+def lineTime(line, clock):
+    """Returns the unix time stamped on a master log line, or None. clock supplies the year of syslog stamps."""
+    # Stamps are taken apart by hand rather than with strptime, which would dominate the run time
+    m = ISO_STAMP.match(line)
+    if m is not None:
+        s = m.group('stamp')
+        fields = (int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    else:
+        m = SYSLOG_STAMP.match(line)
+        if m is None:
+            return None
+        mon, day, hms = m.group('stamp').split()
+        if mon not in MONTHS:
+            return None
+        year = datetime.fromtimestamp(clock).year
+        # A log that runs over new year
+        if MONTHS[mon] < datetime.fromtimestamp(clock).month - 6:
+            year += 1
+        fields = (year, MONTHS[mon], int(day), int(hms[0:2]), int(hms[3:5]), int(hms[6:8]))
+    try:
+        return time.mktime(fields + (0, 0, -1))
+    except (ValueError, OverflowError):
+        return None
+
+def openLog(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt' if sys.version_info[0] > 2 else 'r')
+    return open(path, 'r')
+
+
+class NightStats:
+    """ Accumulates the per night columns, and the failed scripts, while a log is streamed through. """
+
+    def __init__(self):
+        self.nights = dict()
+        self.failures = []
+
+    def night(self, t):
+        n = nightOf(datetime.fromtimestamp(t))
+        row = self.nights.get(n)
+        if row is None:
+            row = self.nights[n] = dict((c, 0.) for c in COLUMNS)
+        return row
+
+    def fail(self, t, script, code):
+        self.night(t)['failed_scripts'] += 1
+        self.failures.append((nightOf(datetime.fromtimestamp(t)), script, code))
+
+    def calibrated(self, start, end):
+        row = self.night(start)
+        row['cal_count'] += 1
+        row['cal_time'] += end - start
+
+    def result(self):
+        return self.nights, self.failures
+
+
+class Collector(robotLog.ExposureRecorder):
+    """ Exposure recorder that counts the exposures instead of writing them out. """
+
+    def __init__(self, stats):
+        robotLog.ExposureRecorder.__init__(self, path=None)
+        self.stats = stats
+
+    def finish(self, status, end):
+        rec = robotLog.ExposureRecorder.finish(self, status, end)
+        row = self.stats.night(rec['start'])
+        if status == 'done':
+            row['exposures'] += 1
+            row['exposure_time'] += rec['duration']
+        elif status == 'interrupted':
+            row['exposures_interrupted'] += 1
+        else:
+            row['exposures_error'] += 1
+        return rec
+
+
+def parseRobotLog(path):
+    """Streams one robot.log, returning its per night statistics."""
+    stats = NightStats()
+    exposures = Collector(stats)
+    end = clock = os.path.getmtime(path)
+    first = True
+    with openLog(path) as f:
+        for line in f:
+            ev = robotLog.parseLine(line, now=clock)
+            if ev is None:
+                continue
+            # Stamps with only a time of day take the date of the previous one. The first one takes
+            # the date the file was last written, unless that puts it after the end of the file.
+            if first:
+                if ev['time'] > end + 60:
+                    ev['time'] -= 86400
+                first = False
+            elif ev['time'] < clock - 43200:
+                ev['time'] += 86400
+            clock = ev['time']
+            # robot.csh failures are counted from its exit in the master log
+            exposures.add(ev)
+    return stats.result()
+
+def match(line):
+    """Returns the name and match of the first of APF_PATTERNS a line matches, or None, None."""
+    for name, pat in APF_PATTERNS:
+        m = pat.search(line)
+        if m is not None:
+            return name, m
+    return None, None
+
+def command(m):
+    words = m.group('cmd').split()
+    return os.path.basename(words[0]) if words else ''
+
+def parseApfLog(path):
+    """Streams one master log, returning its per night statistics."""
+    stats = NightStats()
+    clock = os.path.getmtime(path)
+    reason = None
+    opened = None
+    killed = False
+    # Start times of the commands that haven't been seen to finish
+    pending = dict()
+    with openLog(path) as f:
+        for line in f:
+            t = lineTime(line, clock)
+            if t is None:
+                continue
+            clock = t
+            name, m = match(line)
+            # Older logs have no line for a calibrate that succeeded. It ran until the next line of the master,
+            # other than those of the setup steps running alongside it.
+            if 'calibrate' in pending and not PARALLEL.search(line) and name not in ('finished', 'script_failed', 'cal_start') \
+                    and not (name == 'exec' and command(m) == 'calibrate'):
+                stats.calibrated(pending.pop('calibrate'), t)
+            if name is None:
+                continue
+            row = stats.night(t)
+            if name == 'open':
+                row['opens'] += 1
+                if opened is None:
+                    opened = t
+            elif name == 'open_failed':
+                row['open_failures'] += 1
+                # The exit code is recorded when the command finishes, unless the log is older than that line
+                for script in OPEN_SCRIPTS:
+                    if script in pending:
+                        del pending[script]
+                        stats.fail(t, script, int(m.group('code')))
+            elif name in ('reason', 'opreason'):
+                reason = (t, m.group('reason').strip())
+            elif name == 'close':
+                row['closes'] += 1
+                why = ''
+                if reason is not None and t - reason[0] < REASON_WINDOW:
+                    why = reason[1]
+                if 'sun' in why:
+                    row['close_sun'] += 1
+                elif why and 'Fixed list' not in why and '9AM' not in why:
+                    row['close_weather'] += 1
+                else:
+                    row['close_other'] += 1
+                if opened is not None:
+                    stats.night(opened)['open_time'] += t - opened
+                    opened = None
+                reason = None
+            elif name == 'robot_start':
+                row['robot_starts'] += 1
+                killed = False
+            elif name == 'robot_kill':
+                row['robot_kills'] += 1
+                killed = True
+            elif name == 'robot_stop':
+                row['robot_stops'] += 1
+                code = int(m.group('code'))
+                # A robot the master killed exits with the signal, that isn't a failure
+                if code != 0 and not killed:
+                    stats.fail(t, 'robot.csh', code)
+                killed = False
+            elif name == 'exec':
+                if command(m) == 'calibrate':
+                    pending.setdefault('calibrate', t)
+                else:
+                    pending[command(m)] = t
+            elif name == 'cal_start':
+                pending.setdefault('calibrate', t)
+            elif name == 'finished':
+                script = command(m)
+                code = int(m.group('code'))
+                pending.pop(script, None)
+                if script == 'calibrate':
+                    row['cal_count'] += 1
+                    row['cal_time'] += float(m.group('secs'))
+                if code != 0:
+                    stats.fail(t, script, code)
+            elif name == 'script_failed':
+                # Newer logs have already recorded this when the command finished
+                script = SCRIPTS[m.group('script')]
+                if script in pending:
+                    start = pending.pop(script)
+                    if script == 'calibrate':
+                        stats.calibrated(start, t)
+                    stats.fail(t, script, int(m.group('code')))
+    return stats.result()
+
+def parseLog(job):
+    """Pool worker. job is (kind, path) with kind robot or apflog."""
+    kind, path = job
+    try:
+        if kind == 'robot':
+            return parseRobotLog(path)
+        return parseApfLog(path)
+    except (IOError, OSError) as e:
+        sys.stderr.write("Couldn't read %s: %s\n" % (path, e))
+        return dict(), []
+
+
+def analyze(robotLogs, apfLogs, processes=None):
+    """ Parses every log in a process pool and merges the results. Returns the per night rows and the failed scripts. """
+    jobs = [('robot', p) for p in robotLogs] + [('apflog', p) for p in apfLogs]
+    # Largest files first, so one big log doesn't finish last on its own
+    jobs.sort(key=lambda j: os.path.getsize(j[1]) if os.path.exists(j[1]) else 0, reverse=True)
+    nights = dict()
+    failures = []
+    pool = multiprocessing.Pool(processes)
+    try:
+        for rows, fails in pool.imap_unordered(parseLog, jobs):
+            for n, row in rows.items():
+                total = nights.setdefault(n, dict((c, 0.) for c in COLUMNS))
+                for c in COLUMNS:
+                    total[c] += row[c]
+            failures.extend(fails)
+    finally:
+        pool.close()
+        pool.join()
+    return nights, failures
+
+def tabulate(nights, failures):
+    """Turns the merged results into the columns of the summary file."""
+    cols = dict()
+    names = sorted(nights.keys())
+    cols['night'] = np.array([int(n) for n in names], dtype=np.int32)
+    for c in COLUMNS:
+        cols['night_' + c] = np.array([nights[n][c] for n in names], dtype=np.float32)
+
+    seasons = sorted(set(season(n) for n in names))
+    index = dict((s, i) for i, s in enumerate(seasons))
+    which = np.array([index[season(n)] for n in names], dtype=int)
+    cols['season'] = np.array(seasons, dtype='S5')
+    cols['season_nights'] = np.bincount(which, minlength=len(seasons)).astype(np.int32)
+    for c in COLUMNS:
+        cols['season_' + c] = np.bincount(which, weights=cols['night_' + c], minlength=len(seasons)).astype(np.float32)
+
+    failures.sort()
+    cols['fail_night'] = np.array([int(f[0]) for f in failures], dtype=np.int32)
+    cols['fail_script'] = np.array([f[1] for f in failures], dtype='S32')
+    cols['fail_code'] = np.array([f[2] for f in failures], dtype=np.int32)
+    return cols
+
+def report(cols):
+    print "%-6s %6s %6s %6s %8s %8s %8s %6s" % ("Season", "Nights", "Opens", "Closes", "Open h", "Cal h", "Exp h", "Fails")
+    for i, s in enumerate(cols['season']):
+        print "%-6s %6d %6d %6d %8.1f %8.1f %8.1f %6d" % (s.decode() if isinstance(s, bytes) else s, cols['season_nights'][i],
+            cols['season_opens'][i], cols['season_closes'][i], cols['season_open_time'][i] / 3600.,
+            cols['season_cal_time'][i] / 3600., cols['season_exposure_time'][i] / 3600., cols['season_failed_scripts'][i])
+
+
+def args():
+    parser = argparse.ArgumentParser(description="Summarizes nightly robot.log and apflog files into per night and per season columns.")
+    parser.add_argument('--robot', nargs='*', default=[], help="robot.log files or glob patterns.")
+    parser.add_argument('--apflog', nargs='*', default=[], help="apflog files or glob patterns.")
+    parser.add_argument('-o', '--output', default='log_summary.npz', help="Summary file to write.")
+    parser.add_argument('-j', '--processes', type=int, default=None, help="Worker processes. Defaults to the number of cores.")
+    return parser.parse_args()
+
+def expand(patterns):
+    files = []
+    for p in patterns:
+        files.extend(sorted(glob.glob(p)) or [p])
+    return files
+
+
+if __name__ == '__main__':
+    opt = args()
+    start = time.time()
+    robotLogs = expand(opt.robot)
+    apfLogs = expand(opt.apflog)
+    nights, failures = analyze(robotLogs, apfLogs, opt.processes)
+    cols = tabulate(nights, failures)
+    np.savez_compressed(opt.output, **cols)
+    report(cols)
+    print "Summarized %d logs, %d nights, in %.1f s. Written to %s" % (len(robotLogs) + len(apfLogs), len(nights), time.time() - start, opt.output)
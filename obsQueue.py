@@ -0,0 +1,123 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# obsQueue.py
+# Priority queue of individual observation requests fed by TOO.txt, the fixed list and the dynamic scheduler.
+
+import heapq
+import itertools
+import time
+from datetime import datetime
+
+import numpy as np
+
+from apflog import *
+import starlistFilter as slf
+
+# Higher priorities are observed first. Requests at or above PREEMPT may interrupt the robot.
+TOO     = 100
+FIXED   = 50
+DYNAMIC = 10
+PREEMPT = TOO
+
+# Targets from the dynamic scheduler are only good for the conditions they were picked in
+DYNAMIC_LIFETIME = 900.
+
+
+class ObsRequest:
+    """ One star list line to observe.
+    Requests are ordered by priority, then by rank (their deadline unless one was given), then by arrival.
+    deadline is the unix time after which the target can't be observed. """
+
+    def __init__(self, line, source, priority, deadline=float('inf'), rank=None, index=None):
+        self.line = line if line.endswith('\n') else line + '\n'
+        self.name = line.split()[0]
+        self.source = source
+        self.priority = priority
+        self.deadline = deadline
+        self.rank = deadline if rank is None else rank
+        self.index = index
+        self.attempts = 0
+        # Set once the master has logged that it is holding the request back
+        self.held = False
+
+    def __repr__(self):
+        return "<ObsRequest %s from %s priority %d>" % (self.name, self.source, self.priority)
+
+
+def setTimes(sl, when=None):
+    """Returns the unix time at which each target of a parsed star list sets below the elevation limit."""
+    if when is None:
+        when = datetime.utcnow()
+    now = time.time()
+    lat = np.radians(slf.latitude)
+    dec = np.radians(sl.dec)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosh = (np.sin(np.radians(slf.MIN_EL)) - np.sin(lat)*np.sin(dec)) / (np.cos(lat)*np.cos(dec))
+    h0 = np.degrees(np.arccos(np.clip(cosh, -1, 1))) / 15.
+    ha = slf.hourangle(sl.ra, when)
+    # Sidereal hours until the hour angle reaches h0
+    left = np.where(ha <= h0, h0 - ha, 24. - ha + h0)
+    out = now + left * 3600. * 0.99727
+    out[cosh <= -1] = float('inf')
+    out[cosh >= 1] = now
+    return out
+
+
+class ObsQueue:
+    """ Heap of ObsRequests. push and pop are O(log n); expired requests are dropped when they reach the top. """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, req):
+        heapq.heappush(self.heap, (-req.priority, req.rank, next(self.counter), req))
+        self.count += 1
+
+    def _clean(self, now):
+        while self.heap:
+            req = self.heap[0][3]
+            if req.deadline < now:
+                heapq.heappop(self.heap)
+                self.count -= 1
+                apflog("Dropping %s, it is no longer observable." % req.name, echo=True)
+            else:
+                break
+
+    def peek(self, now=None):
+        """Returns the best request without removing it, or None."""
+        if now is None:
+            now = time.time()
+        self._clean(now)
+        if self.heap:
+            return self.heap[0][3]
+        return None
+
+    def pop(self, now=None):
+        """Removes and returns the best request, or None."""
+        if self.peek(now) is None:
+            return None
+        self.count -= 1
+        return heapq.heappop(self.heap)[3]
+
+    def addStarlist(self, filename, source, priority, skip=0, lifetime=None):
+        """ Queues each target line of a star list after the first skip lines, returning the number queued.
+        Fixed lists keep their file order; other sources are ordered by when their targets set. """
+        sl = slf.Starlist(filename)
+        if len(sl) == 0:
+            return 0
+        deadlines = setTimes(sl)
+        if lifetime is not None:
+            deadlines = np.minimum(deadlines, time.time() + lifetime)
+        n = 0
+        for i in range(skip, len(sl)):
+            if source == 'fixed':
+                req = ObsRequest(sl.lines[i], source, priority, float(deadlines[i]), rank=i, index=i)
+            else:
+                req = ObsRequest(sl.lines[i], source, priority, float(deadlines[i]))
+            self.push(req)
+            n += 1
+        return n
@@ -0,0 +1,139 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# phaseGraph.py
+# Runs the afternoon setup steps as a dependency graph, so independent steps happen at the same time.
+
+import sys
+import time
+import threading
+import Queue
+
+import APFTask
+from apflog import *
+
+
+def parallel(funcs):
+    """Calls each function in its own thread and returns their results in order. Exceptions are re-raised."""
+    results = [None] * len(funcs)
+    errors = []
+    def call(i, f):
+        try:
+            results[i] = f()
+        except Exception:
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=call, args=(i, f)) for i, f in enumerate(funcs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class PhaseNode:
+    """ One setup step. func returns a true value on success.
+    phase is the master phase the step belongs to, and checkpoint the phase to record once it is done. """
+
+    def __init__(self, name, func, deps=(), phase=None, checkpoint=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.phase = phase
+        self.checkpoint = checkpoint
+        self.start = None
+        self.end = None
+        self.result = None
+
+
+class PhaseGraph:
+    """ Runs PhaseNodes as soon as everything they depend on has finished. Completed checkpoints are written to
+    the task phase keyword so a restart picks up from there. """
+
+    def __init__(self, task, phases):
+        self.task = task
+        self.phases = list(phases)
+        self.nodes = []
+        self.byname = dict()
+
+    def add(self, name, func, deps=(), phase=None, checkpoint=None):
+        node = PhaseNode(name, func, deps, phase, checkpoint)
+        self.nodes.append(node)
+        self.byname[name] = node
+        return node
+
+    def _run(self, node, done):
+        node.start = time.time()
+        try:
+            node.result = node.func()
+        except Exception as e:
+            apflog("Setup step %s raised %s" % (node.name, repr(e)), level='error', echo=True)
+            node.result = False
+        node.end = time.time()
+        done.put(node)
+
+    def run(self, start=None):
+        """ Runs the graph, skipping nodes of phases before start. Returns None on success, or the failed node.
+        Once a node fails no new nodes are started, but those already running are allowed to finish. """
+        skip = []
+        if start in self.phases:
+            skip = self.phases[:self.phases.index(start)]
+        for n in self.nodes:
+            n.start = n.end = n.result = None
+        finished = set(n.name for n in self.nodes if n.phase in skip)
+        waiting = [n for n in self.nodes if n.name not in finished]
+        done = Queue.Queue()
+        running = 0
+        failed = None
+        self.t0 = time.time()
+        while waiting or running:
+            if failed is None:
+                for node in [n for n in waiting if all(d in finished for d in n.deps)]:
+                    waiting.remove(node)
+                    apflog("Starting setup step %s" % node.name, echo=True)
+                    threading.Thread(target=self._run, args=(node, done), name=node.name).start()
+                    running += 1
+            elif not running:
+                break
+            if not running:
+                # Nothing can run, the remaining nodes depend on something missing
+                apflog("Setup steps %s can't be run." % ", ".join(n.name for n in waiting), level='error', echo=True)
+                return waiting[0]
+            node = done.get()
+            running -= 1
+            if not node.result:
+                apflog("Setup step %s failed after %.1f s" % (node.name, node.end - node.start), level='error', echo=True)
+                if failed is None:
+                    failed = node
+                continue
+            apflog("Setup step %s finished in %.1f s" % (node.name, node.end - node.start), echo=True)
+            finished.add(node.name)
+            if node.checkpoint is not None:
+                APFTask.phase(self.task, node.checkpoint)
+        if failed is None:
+            self.report()
+        return failed
+
+    def criticalPath(self):
+        """The chain of nodes that determined the total run time, from first to last."""
+        ran = [n for n in self.nodes if n.end is not None]
+        if not ran:
+            return []
+        node = max(ran, key=lambda n: n.end)
+        path = [node]
+        while True:
+            deps = [self.byname[d] for d in node.deps if self.byname[d].end is not None]
+            if not deps:
+                break
+            node = max(deps, key=lambda n: n.end)
+            path.append(node)
+        path.reverse()
+        return path
+
+    def report(self):
+        path = self.criticalPath()
+        if not path:
+            return
+        total = path[-1].end - self.t0
+        serial = sum(n.end - n.start for n in self.nodes if n.end is not None)
+        apflog("Setup took %.1f s, %.1f s if run one step at a time." % (total, serial), echo=True)
+        apflog("Critical path: %s" % " -> ".join("%s (%.1f s)" % (n.name, n.end - n.start) for n in path), echo=True)
@@ -0,0 +1,173 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# profiler.py
+# On demand sampling profiler for the live master, switched on and off with a master task keyword.
+
+import os
+import sys
+import time
+import threading
+from datetime import datetime
+
+from apflog import *
+
+ProfileDir = '/u/rjhanson/master/profiles/'
+
+# Seconds between samples. The interval is stretched if sampling takes more than MAX_OVERHEAD of the time.
+INTERVAL = 0.02
+MAX_OVERHEAD = 0.01
+# Seconds between dumps while profiling, so a crash still leaves something to look at
+DUMP_INTERVAL = 300.
+# Number of call sites listed in the summary
+TOP = 25
+# Blocking time inside the standard library (threading, Queue, subprocess...) is charged to the first caller outside it
+STDLIB = os.path.dirname(os.__file__)
+
+
+def keywordOn(value):
+    """Interprets the toggle keyword. Anything but blank, 0 and off turns profiling on."""
+    return str(value).strip().lower() not in ('', '0', 'off', 'false', 'no')
+
+def stdlib(filename):
+    return filename.startswith(STDLIB) and 'site-packages' not in filename
+
+def frameName(frame):
+    code = frame.f_code
+    return "%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno)
+
+
+class Profiler(threading.Thread):
+    """ Samples the stacks of every thread in the process from a background thread. Writes collapsed stacks,
+    one line per unique stack with its sample count, which flamegraph.pl and speedscope read directly,
+    and a summary of the call sites the threads spend their time blocked in. """
+
+    def __init__(self, outdir=ProfileDir, interval=INTERVAL):
+        threading.Thread.__init__(self, name='profiler')
+        self.setDaemon(True)
+        self.outdir = outdir
+        self.interval = interval
+        self.stacks = dict()
+        self.blocked = dict()
+        self.samples = 0
+        self.sampleTime = 0.
+        self.started = None
+        self.signal = threading.Event()
+
+    def sample(self):
+        me = threading.current_thread().ident
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            leaf = frame
+            stack = []
+            while frame is not None:
+                stack.append(frameName(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+            key = ";".join(stack)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+
+            caller = leaf
+            while caller.f_back is not None and stdlib(caller.f_code.co_filename):
+                caller = caller.f_back
+            if caller is leaf:
+                site = frameName(leaf)
+            else:
+                site = "%s -> %s.%s" % (frameName(caller), os.path.splitext(os.path.basename(leaf.f_code.co_filename))[0], leaf.f_code.co_name)
+            self.blocked[site] = self.blocked.get(site, 0) + 1
+        self.samples += 1
+
+    def run(self):
+        self.started = time.time()
+        lastDump = self.started
+        apflog("Profiler started, writing to %s" % self.outdir, echo=True)
+        while not self.signal.is_set():
+            t0 = time.time()
+            try:
+                self.sample()
+            except Exception as e:
+                apflog("Profiler sample failed: %s" % repr(e), level='warn')
+            spent = time.time() - t0
+            self.sampleTime += spent
+            if time.time() - lastDump > DUMP_INTERVAL:
+                self.dump()
+                lastDump = time.time()
+            self.signal.wait(max(self.interval, spent / MAX_OVERHEAD - spent))
+        self.dump()
+        apflog("Profiler stopped after %d samples, %.2f%% overhead" % (self.samples, 100 * self.overhead()), echo=True)
+
+    def overhead(self):
+        """Fraction of the wall clock time the sampler has been running."""
+        if not self.started:
+            return 0.
+        return self.sampleTime / max(time.time() - self.started, 1e-6)
+
+    def stop(self):
+        self.signal.set()
+
+    def topSites(self, n=TOP):
+        return sorted(self.blocked.items(), key=lambda s: s[1], reverse=True)[:n]
+
+    def dump(self):
+        """Writes the collapsed stacks and the call site summary. Returns the file name prefix."""
+        if not self.started:
+            return None
+        prefix = os.path.join(self.outdir, "master_%s" % datetime.fromtimestamp(self.started).strftime("%Y%m%d_%H%M%S"))
+        try:
+            if not os.path.isdir(self.outdir):
+                os.makedirs(self.outdir)
+            with open(prefix + ".folded", 'w') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write("%s %d\n" % (stack, count))
+            with open(prefix + ".top", 'w') as f:
+                f.write("# %d samples over %.0f s, %.2f%% overhead\n" % (self.samples, time.time() - self.started, 100 * self.overhead()))
+                # threads is the average number of threads found at the call site
+                f.write("# samples   threads  call site\n")
+                for site, count in self.topSites():
+                    f.write("%9d %9.3f  %s\n" % (count, float(count) / max(self.samples, 1), site))
+        except (IOError, OSError) as e:
+            apflog("Couldn't write profile %s: %s" % (prefix, repr(e)), level='warn')
+            return None
+        return prefix
+
+
+class ProfileSwitch:
+    """ Starts and stops a Profiler when a keyword changes, see watch(). """
+
+    def __init__(self, outdir=ProfileDir, interval=INTERVAL):
+        self.outdir = outdir
+        self.interval = interval
+        self.profiler = None
+        self.lock = threading.Lock()
+
+    def set(self, on):
+        with self.lock:
+            running = self.profiler is not None and self.profiler.is_alive()
+            if on and not running:
+                self.profiler = Profiler(self.outdir, self.interval)
+                self.profiler.start()
+            elif not on and running:
+                self.profiler.stop()
+                # Let it write its final dump
+                self.profiler.join(10)
+                self.profiler = None
+
+    def callback(self, keyword):
+        try:
+            value = keyword.read()
+        except Exception:
+            return
+        self.set(keywordOn(value))
+
+    def watch(self, keyword):
+        """Monitors the keyword, profiling whenever it is set to something other than 0 or off."""
+        keyword.monitor()
+        keyword.callback(self.callback)
+        try:
+            self.set(keywordOn(keyword.read()))
+        except Exception as e:
+            apflog("Couldn't read the profiler keyword: %s" % repr(e), level='warn')
+
+    def stop(self):
+        self.set(False)
@@ -0,0 +1,148 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# resourceWatch.py
+# Watches the memory, file descriptors, threads and child processes of the master over the night.
+
+import os
+import time
+import threading
+
+from apflog import *
+
+# tracemalloc only exists from Python 3.4
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Seconds between samples, and between routine log lines
+INTERVAL = 60.
+LOG_INTERVAL = 1800.
+# Warn above these levels, or once a resource has grown by GROWTH times over its level at the start
+RSS_LIMIT = 1024.
+FD_LIMIT = 512
+THREAD_LIMIT = 100
+ZOMBIE_LIMIT = 5
+GROWTH = 2.0
+# After a warning, the same resource is only warned about again once it has grown this much more
+REWARN = 1.25
+# Frames kept per allocation, and allocation sites logged, when tracemalloc is on
+TRACE_FRAMES = 5
+TRACE_TOP = 10
+
+
+def rss():
+    """Resident memory of this process in MB."""
+    with open('/proc/self/status', 'r') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return float(line.split()[1]) / 1024.
+    return 0.
+
+def openFiles():
+    return len(os.listdir('/proc/self/fd'))
+
+def children(pid=None):
+    """Returns (children, zombies) of the process, read from /proc."""
+    if pid is None:
+        pid = os.getpid()
+    kids = zombies = 0
+    for d in os.listdir('/proc'):
+        if not d.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % d, 'r') as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # The command name is in parentheses and may contain spaces, the fields after it are fixed
+        fields = stat[stat.rfind(')') + 2:].split()
+        if len(fields) > 1 and int(fields[1]) == pid:
+            kids += 1
+            if fields[0] == 'Z':
+                zombies += 1
+    return kids, zombies
+
+def sample():
+    """The current resource use of the process as a dictionary."""
+    kids, zombies = children()
+    return dict(rss=rss(), fds=openFiles(), threads=threading.active_count(), children=kids, zombies=zombies)
+
+
+class ResourceWatchdog(threading.Thread):
+    """ Samples the resource use of the process every INTERVAL seconds, logs it every LOG_INTERVAL, and warns when
+    something passes its limit or has grown a lot since the start. Samples also go to the telemetry rollup,
+    if one is given, so growth over the night can be plotted. With trace set, tracemalloc records allocations
+    and the top allocation sites are logged with each warning; this slows the master down noticeably, so it is off by default. """
+
+    limits = dict(rss=RSS_LIMIT, fds=FD_LIMIT, threads=THREAD_LIMIT, zombies=ZOMBIE_LIMIT)
+
+    def __init__(self, rollup=None, trace=False, interval=INTERVAL):
+        threading.Thread.__init__(self, name='resources')
+        self.setDaemon(True)
+        self.rollup = rollup
+        self.interval = interval
+        self.trace = trace and tracemalloc is not None
+        self.baseline = None
+        self.warned = dict()
+        self.last = None
+        self.signal = threading.Event()
+        if trace and tracemalloc is None:
+            apflog("tracemalloc isn't available in this Python, not tracing allocations.", level='warn')
+
+    def check(self, now=None):
+        """Takes a sample and logs or warns about it as needed. Returns the sample."""
+        if now is None:
+            now = time.time()
+        st = sample()
+        if self.baseline is None:
+            self.baseline = st
+        if self.rollup is not None:
+            for k, v in st.items():
+                self.rollup.add('master_' + k, v, now)
+
+        problems = []
+        for k, limit in self.limits.items():
+            base = max(self.baseline[k], 1)
+            level = min(limit, GROWTH * base) if k != 'zombies' else limit
+            if st[k] <= level:
+                self.warned.pop(k, None)
+                continue
+            if k in self.warned and st[k] < REWARN * self.warned[k]:
+                continue
+            self.warned[k] = st[k]
+            problems.append("%s %s (started at %s, limit %s)" % (k, fmt(st[k]), fmt(self.baseline[k]), fmt(limit)))
+        if problems:
+            apflog("Master resource use is growing: %s" % ", ".join(problems), level='warn', echo=True)
+            self.logAllocations()
+        elif self.last is None or now - self.last > LOG_INTERVAL:
+            apflog("Master resources: " + ", ".join("%s %s" % (k, fmt(st[k])) for k in sorted(st.keys())))
+            self.last = now
+        return st
+
+    def logAllocations(self):
+        if not self.trace:
+            return
+        snap = tracemalloc.take_snapshot()
+        for stat in snap.statistics('lineno')[:TRACE_TOP]:
+            apflog("Allocated %.1f kB in %d blocks at %s" % (stat.size / 1024., stat.count, stat.traceback), level='warn')
+
+    def run(self):
+        if self.trace:
+            tracemalloc.start(TRACE_FRAMES)
+        while not self.signal.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                apflog("Couldn't sample the master resources: %s" % repr(e), level='warn')
+            self.signal.wait(self.interval)
+        if self.trace:
+            tracemalloc.stop()
+
+    def stop(self):
+        self.signal.set()
+
+
+def fmt(v):
+    if isinstance(v, float):
+        return "%.0f MB" % v
+    return str(v)
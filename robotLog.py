@@ -0,0 +1,222 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# robotLog.py
+# Follows the robot.csh output as it is written and turns it into structured exposure events.
+
+import os
+import re
+import time
+import json
+import threading
+import Queue
+from datetime import datetime
+
+from apflog import *
+
+RobotLog = 'robot.log'
+# Exposure records are written here, in the master directory
+ExposureFile = 'robot_exposures.jsonl'
+
+# Event name and the pattern that identifies it in the robot output. The first match wins, so the exposure
+# and acquisition lines come before error, and error only matches a line that starts with an error marker or
+# reports an exit or return code. Whether these match the robot's wording can be checked against a night's
+# robot.log with ./robotLog.py robot.log, which lists the lines that look relevant but match nothing.
+PATTERNS = [
+    ('exposure_start', re.compile(r'(?i)\b(?:start(?:ing|ed)? (?:an? )?exposure|exposure start(?:ed|ing)?)\b(?:.*?obsnum\s*[=:]?\s*(?P<obsnum>\d+))?(?:.*?(?P<texp>\d+(?:\.\d*)?)\s*s(?:ec)?\b)?')),
+    ('exposure_end',   re.compile(r'(?i)\b(?:exposure (?:finished|complete[d]?|done|ended)|readout (?:begin|complete[d]?))\b(?:.*?obsnum\s*[=:]?\s*(?P<obsnum>\d+))?')),
+    ('acquired',       re.compile(r'(?i)\b(?:acquired|acquiring|slewing to|slew to)\s+(?:target\s+)?(?P<target>[\w+\-.]+)')),
+    ('error',          re.compile(r'(?i)^[\s\d:T\-\[\]]*(?:[\w.]+:\s*)?error\b|\b(?:failed|exited|aborted)\b.*?\b(?:exit|return)?\s*(?:code|status)\s*[=:]?\s*(?P<code>-?\d+)')),
+]
+
+# Lines worth a look when checking the patterns against a log
+RELEVANT = re.compile(r'(?i)expos|readout|error|fail|abort|acquir|slew')
+
+# Optional timestamp at the start of a robot output line
+STAMP = re.compile(r'^\s*\[?(?P<date>\d{4}-\d{2}-\d{2}[ T])?(?P<time>\d{2}:\d{2}:\d{2})\]?\s*')
+
+
+def parseLine(line, now=None):
+    """ Returns the event described by a line of robot output as a dictionary, or None.
+    Events have the keys event, time (unix seconds), line, and any fields parsed from the line. """
+    if now is None:
+        now = time.time()
+    for name, pat in PATTERNS:
+        m = pat.search(line)
+        if m is None:
+            continue
+        ev = dict((k, v) for k, v in m.groupdict().items() if v is not None)
+        ev['event'] = name
+        ev['line'] = line.rstrip('\n')
+        ev['time'] = now
+        s = STAMP.match(line)
+        if s is not None:
+            # Built by hand rather than with strptime, which dominates the time taken to read archived logs
+            if s.group('date'):
+                d = s.group('date')
+                ymd = (int(d[0:4]), int(d[5:7]), int(d[8:10]))
+            else:
+                ymd = datetime.fromtimestamp(now).timetuple()[:3]
+            hms = s.group('time')
+            try:
+                ev['time'] = time.mktime(ymd + (int(hms[0:2]), int(hms[3:5]), int(hms[6:8]), 0, 0, -1))
+            except (ValueError, OverflowError):
+                pass
+        return ev
+    return None
+
+
+class ExposureRecorder:
+    """ Assembles events into one record per exposure and appends them to a JSON lines file, if a path is given. """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.target = None
+        self.current = None
+
+    def add(self, ev):
+        if ev['event'] == 'acquired':
+            self.target = ev['target']
+        elif ev['event'] == 'exposure_start':
+            if self.current is not None:
+                self.finish('interrupted', ev['time'])
+            self.current = {'target': self.target, 'start': ev['time'], 'obsnum': ev.get('obsnum'), 'texp': ev.get('texp')}
+        elif ev['event'] == 'exposure_end':
+            if self.current is not None:
+                self.finish('done', ev['time'])
+        elif ev['event'] == 'error' and 'code' in ev:
+            if self.current is not None:
+                self.current['error'] = ev['line']
+                self.finish('error', ev['time'])
+
+    def finish(self, status, end):
+        """Closes the current exposure record and returns it."""
+        rec = self.current
+        self.current = None
+        rec['end'] = end
+        rec['duration'] = end - rec['start']
+        rec['status'] = status
+        if self.path is None:
+            return rec
+        try:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(rec) + '\n')
+        except IOError:
+            apflog("Couldn't record exposure in %s" % self.path)
+        return rec
+
+
+class RobotLogWatcher(threading.Thread):
+    """ Tails the robot output file and puts parsed events on self.events for the master.
+    Starts at the current end of the file, and follows the file if it is truncated or replaced. """
+
+    def __init__(self, path=RobotLog, recorder=None, poll=0.2):
+        threading.Thread.__init__(self)
+        self.name = 'robotlog'
+        self.daemon = True
+        self.path = path
+        self.poll = poll
+        self.events = Queue.Queue()
+        self.recorder = recorder if recorder is not None else ExposureRecorder()
+        self.signal = True
+
+    def _open(self, end):
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return None
+        if end:
+            f.seek(0, os.SEEK_END)
+        return f
+
+    def run(self):
+        f = self._open(end=True)
+        partial = ''
+        while self.signal:
+            if f is None:
+                time.sleep(self.poll)
+                f = self._open(end=False)
+                continue
+            line = f.readline()
+            if line == '':
+                # Nothing new. Check if the file was truncated or replaced.
+                try:
+                    st = os.stat(self.path)
+                except OSError:
+                    st = None
+                if st is None or st.st_ino != os.fstat(f.fileno()).st_ino or st.st_size < f.tell():
+                    f.close()
+                    f = self._open(end=False)
+                    partial = ''
+                else:
+                    time.sleep(self.poll)
+                continue
+            if not line.endswith('\n'):
+                partial += line
+                continue
+            line = partial + line
+            partial = ''
+            ev = parseLine(line)
+            if ev is not None:
+                self.recorder.add(ev)
+                self.events.put(ev)
+        if f is not None:
+            f.close()
+
+    def stop(self):
+        self.signal = False
+
+    def pending(self):
+        """Returns all the events that have arrived since the last call."""
+        evs = []
+        while True:
+            try:
+                evs.append(self.events.get_nowait())
+            except Queue.Empty:
+                return evs
+
+
+class Tally(ExposureRecorder):
+    """ Exposure recorder that keeps the records in memory. """
+
+    def __init__(self):
+        ExposureRecorder.__init__(self)
+        self.records = []
+
+    def finish(self, status, end):
+        rec = ExposureRecorder.finish(self, status, end)
+        self.records.append(rec)
+        return rec
+
+
+def check(path):
+    """ Reads a robot.log and prints how many of each event it gives and the exposures they add up to, then the
+    lines that look relevant but match no pattern, so the patterns can be checked against the robot's output. """
+    counts = dict((name, 0) for name, pat in PATTERNS)
+    recorder = Tally()
+    missed = []
+    clock = os.path.getmtime(path)
+    with open(path, 'r') as f:
+        for line in f:
+            ev = parseLine(line, now=clock)
+            if ev is None:
+                if RELEVANT.search(line):
+                    missed.append(line.rstrip('\n'))
+                continue
+            counts[ev['event']] += 1
+            recorder.add(ev)
+    for name, pat in PATTERNS:
+        print "%-22s %6d" % (name, counts[name])
+    for status in ['done', 'interrupted', 'error']:
+        print "%-22s %6d" % ("exposures " + status, len([r for r in recorder.records if r['status'] == status]))
+    print "%d relevant line(s) matched no pattern:" % len(missed)
+    for line in missed:
+        print "    " + line
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        print "Usage: robotLog.py robot.log [robot.log ...]"
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        print path
+        check(path)
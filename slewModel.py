@@ -0,0 +1,208 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# slewModel.py
+# Slew time model fitted from the recorded AAZ/AEL history, and slew minimizing ordering of fixed star lists.
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from apflog import *
+import starlistFilter as slf
+
+SlewFile = '/u/rjhanson/master/slews.txt'
+
+# Anything moving faster than this (deg/s) is slewing rather than tracking
+SLEW_RATE = 0.2
+# Seconds without motion before a slew is considered finished
+SETTLE = 3.0
+# Slews shorter than this (deg) are offsets, not target changes
+MIN_SLEW = 1.0
+# Default model: settle overhead (s), seconds per degree of azimuth, seconds per degree of elevation
+DEFAULT_PARAMS = (30.0, 0.5, 0.5)
+# Exposure time to assume for lines without texp=
+DEFAULT_TEXP = 600.0
+# Longer lists only get the nearest neighbour tour
+MAX_2OPT = 400
+# Candidate 2-opt moves checked against the full schedule for each position
+MAX_TRIES = 3
+
+
+def azdist(az1, az2):
+    return np.abs(np.mod(az2 - az1 + 180., 360.) - 180.)
+
+
+class SlewModel:
+    """ Estimates slew time as overhead + b*|dAz| + c*|dEl|.
+    The dome follows the telescope in azimuth, so dome rotation is folded into the azimuth term.
+    Slews are found in the AAZ/AEL stream passed to record(), and kept in SlewFile across nights. """
+
+    def __init__(self, path=SlewFile):
+        self.path = path
+        self.slews = []
+        self.params = DEFAULT_PARAMS
+        self.last = None
+        self.moving = False
+        self.start = None
+        self.lastmove = None
+
+        if self.path is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    for line in f:
+                        try:
+                            self.slews.append(tuple(float(v) for v in line.split()[1:4]))
+                        except ValueError:
+                            continue
+            except IOError:
+                pass
+        self.fit()
+
+    def record(self, t, az, el):
+        """Adds a telescope position sample taken at unix time t."""
+        if self.last is not None:
+            lt, laz, lel = self.last
+            dt = t - lt
+            if dt > 0:
+                rate = max(azdist(laz, az), abs(el - lel)) / dt
+                if rate > SLEW_RATE:
+                    if not self.moving:
+                        self.moving = True
+                        self.start = self.last
+                    self.lastmove = t
+                elif self.moving and t - self.lastmove > SETTLE:
+                    self.moving = False
+                    st, saz, sel = self.start
+                    daz = azdist(saz, az)
+                    de  = abs(el - sel)
+                    if daz + de > MIN_SLEW:
+                        self.addSlew(self.lastmove - st, daz, de)
+        self.last = (t, az, el)
+
+    def addSlew(self, duration, daz, de):
+        self.slews.append((duration, daz, de))
+        if self.path is not None:
+            try:
+                with open(self.path, 'a') as f:
+                    f.write("%s %.1f %.2f %.2f\n" % (datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), duration, daz, de))
+            except IOError:
+                pass
+        self.fit()
+
+    def fit(self):
+        """Least squares fit of the model to the recorded slews. Keeps the defaults until there are enough slews."""
+        if len(self.slews) < 5:
+            return self.params
+        s = np.array(self.slews[-500:], dtype=float)
+        A = np.column_stack((np.ones(len(s)), s[:,1], s[:,2]))
+        p = np.linalg.lstsq(A, s[:,0], rcond=None)[0]
+        # A negative rate means the fit is not yet constrained, keep what we had
+        if np.all(p >= 0):
+            self.params = tuple(p)
+        return self.params
+
+    def time(self, az1, el1, az2, el2):
+        """Predicted slew time in seconds between positions. Works on arrays."""
+        a, b, c = self.params
+        return a + b*azdist(az1, az2) + c*np.abs(np.asarray(el2) - el1)
+
+
+def schedule(sl, order, model, when, az, el, texp=None, iterations=3):
+    """ Steps through the targets in order starting at UTC time when from position az, el.
+    Returns the total slew time, whether every target was observable when reached,
+    and the azimuth and elevation of each target when reached.
+    Arrival times are found by iteration: the target positions at the estimated arrival times give
+    the slew times, which give new arrival times. Each iteration is a single array computation. """
+    order = np.asarray(order, dtype=int)
+    if len(order) == 0:
+        return 0.0, True, np.empty(0), np.empty(0)
+    if texp is None:
+        texp = sl.column('texp', DEFAULT_TEXP)
+    texp = texp[order]
+    ra, dec = sl.ra[order], sl.dec[order]
+    waits = np.concatenate(([0.], np.cumsum(texp[:-1])))
+    offset = np.zeros(len(order))
+    for _ in range(iterations):
+        tel, taz, tam = slf.altaz(ra, dec, when, offset)
+        st = model.time(np.concatenate(([az], taz[:-1])), np.concatenate(([el], tel[:-1])), taz, tel)
+        offset = np.cumsum(st) + waits
+    tel, taz, tam = slf.altaz(ra, dec, when, offset)
+    ok = bool(np.all((tel >= slf.MIN_EL) & (tel <= slf.MAX_EL) & (tam <= slf.MAX_AIRMASS)))
+    return float(np.sum(st)), ok, taz, tel
+
+def order(sl, model, when, az, el, passes=3):
+    """ Orders the targets of a star list to reduce total slew time, starting from position az, el at UTC time when.
+    A nearest neighbour tour, only choosing targets observable when reached, is refined with 2-opt moves
+    which are kept only if every target stays observable. Lists longer than MAX_2OPT only get the nearest
+    neighbour tour. Returns the new order as a list of indices. """
+    texp = sl.column('texp', DEFAULT_TEXP)
+    left = list(range(len(sl)))
+    tour = []
+    t = when
+    caz, cel = az, el
+    while left:
+        tel, taz, tam = slf.altaz(sl.ra[left], sl.dec[left], t)
+        cost = model.time(caz, cel, taz, tel)
+        ok = (tel >= slf.MIN_EL) & (tel <= slf.MAX_EL) & (tam <= slf.MAX_AIRMASS)
+        # Nothing observable from here, take the rest in file order
+        if not ok.any():
+            tour.extend(left)
+            break
+        cost[~ok] = np.inf
+        j = int(np.argmin(cost))
+        i = left.pop(j)
+        tour.append(i)
+        t = t + timedelta(seconds=float(cost[j] + texp[i]))
+        caz, cel = taz[j], tel[j]
+
+    n = len(tour)
+    if n < 3 or n > MAX_2OPT:
+        return tour
+    best, feasible, azs, els = schedule(sl, tour, model, when, az, el, texp)
+    for _ in range(passes):
+        improved = False
+        # Moves are ranked by the change in the two slews they replace, using the target positions of the
+        # current schedule, then the best few are checked by recomputing the schedule.
+        paz = np.concatenate(([az], azs))
+        pel = np.concatenate(([el], els))
+        for i in range(n - 1):
+            k = np.arange(i + 1, n)
+            before = np.repeat(model.time(paz[i], pel[i], paz[i+1], pel[i+1]), len(k))
+            after = model.time(paz[i], pel[i], paz[k+1], pel[k+1])
+            kk = k[k + 1 < n]
+            before[:len(kk)] += model.time(paz[kk+1], pel[kk+1], paz[kk+2], pel[kk+2])
+            after[:len(kk)] += model.time(paz[i+1], pel[i+1], paz[kk+2], pel[kk+2])
+            gain = before - after
+            for j in np.argsort(-gain)[:MAX_TRIES]:
+                if gain[j] <= 1.0:
+                    break
+                trial = tour[:i] + tour[i:k[j]+1][::-1] + tour[k[j]+1:]
+                total, tok, tazs, tels = schedule(sl, trial, model, when, az, el, texp)
+                if total < best and (tok or not feasible):
+                    tour, best, feasible, azs, els = trial, total, tok, tazs, tels
+                    paz = np.concatenate(([az], azs))
+                    pel = np.concatenate(([el], els))
+                    improved = True
+                    break
+        if not improved:
+            break
+    return tour
+
+def orderStarlist(filename, outfile, model, az, el, when=None):
+    """ Writes a slew minimizing ordering of a star list to outfile.
+    Returns the predicted total slew time of the original and the new order, in seconds. """
+    if when is None:
+        # The list is prepared in the afternoon, so plan for the night it will be observed
+        when = slf.twilight(datetime.utcnow())
+    sl = slf.Starlist(filename)
+    if len(sl) == 0:
+        sl.write(outfile, [])
+        return 0.0, 0.0
+    orig = list(range(len(sl)))
+    texp = sl.column('texp', DEFAULT_TEXP)
+    before, _, _, _ = schedule(sl, orig, model, when, az, el, texp)
+    tour = order(sl, model, when, az, el)
+    after, _, _, _ = schedule(sl, tour, model, when, az, el, texp)
+    if after >= before:
+        tour, after = orig, before
+    sl.write(outfile, tour)
+    return before, after
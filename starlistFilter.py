@@ -0,0 +1,194 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# starlistFilter.py
+# Vectorized observability checks for star lists before they are handed to robot.csh
+
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from apflog import *
+
+# Lick Observatory, Mt. Hamilton
+latitude  = 37.3425
+longitude = -121.6425
+
+# Telescope and dome limits, degrees
+MIN_EL = 15.0
+MAX_EL = 85.0
+MAX_AIRMASS = 3.5
+
+# When the wind is above this speed (mph) targets within WIND_EXCLUDE_ANGLE
+# of the wind direction are treated as unobservable.
+WIND_EXCLUDE_SPEED = 20.0
+WIND_EXCLUDE_ANGLE = 30.0
+
+
+class Starlist:
+    """ A parsed star list. Coordinates and keywords are held in arrays, one entry per target line.
+    Comment and blank lines are kept in header so they can be written back out. Lines that can't be parsed
+    are left out, with the reason, in unparsed. """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = []
+        self.lines  = []
+        self.names  = []
+        self.keys   = []
+        self.unparsed = []
+        ra  = []
+        dec = []
+        with open(filename, 'r') as f:
+            for line in f:
+                ls = line.strip()
+                if ls == '' or ls[0] == '#':
+                    self.header.append(line)
+                    continue
+                p = ls.split()
+                try:
+                    r = (float(p[1]) + float(p[2])/60. + float(p[3])/3600.) * 15.
+                    d = abs(float(p[4])) + float(p[5])/60. + float(p[6])/3600.
+                except (IndexError, ValueError):
+                    apflog("Couldn't parse star list line: %s" % ls, echo=True)
+                    self.unparsed.append((p[0], "couldn't parse the coordinates"))
+                    continue
+                if p[4].startswith('-'):
+                    d = -d
+                kw = dict()
+                for item in p[7:]:
+                    if '=' in item:
+                        k, v = item.split('=', 1)
+                        kw[k.lower()] = v
+                self.lines.append(line if line.endswith('\n') else line + '\n')
+                self.names.append(p[0])
+                self.keys.append(kw)
+                ra.append(r)
+                dec.append(d)
+        self.ra  = np.array(ra, dtype=float)
+        self.dec = np.array(dec, dtype=float)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def column(self, key, default=np.nan):
+        """Returns the value of a star list keyword (eg. vmag, texp) for every target as a float array."""
+        out = np.empty(len(self.lines), dtype=float)
+        for i, kw in enumerate(self.keys):
+            try:
+                out[i] = float(kw[key])
+            except (KeyError, ValueError):
+                out[i] = default
+        return out
+
+    def write(self, filename, order):
+        """Writes the header followed by the target lines with the given indices, in order."""
+        with open(filename, 'w') as f:
+            for line in self.header:
+                f.write(line)
+            for i in order:
+                f.write(self.lines[i])
+
+
+# Sun elevation above which the night is over
+TWILIGHT = -8.9
+
+
+def julian(when):
+    return 2440587.5 + (when - datetime(1970, 1, 1)).total_seconds() / 86400.
+
+def lst(when, offset=0.0):
+    """Local sidereal time in degrees for a UTC datetime, plus offset seconds (which may be an array)."""
+    jd = julian(when) + np.asarray(offset, dtype=float) / 86400.
+    gmst = 18.697374558 + 24.06570982441908 * (jd - 2451545.0)
+    return np.mod(gmst * 15. + longitude, 360.)
+
+def sun(when):
+    """Low precision RA and Dec of the Sun in degrees at a UTC datetime."""
+    d = julian(when) - 2451545.0
+    g = math.radians(357.529 + 0.98560028 * d)
+    q = 280.459 + 0.98564736 * d
+    l = math.radians(q + 1.915 * math.sin(g) + 0.020 * math.sin(2*g))
+    e = math.radians(23.439 - 0.00000036 * d)
+    ra = math.degrees(math.atan2(math.cos(e) * math.sin(l), math.cos(l))) % 360.
+    dec = math.degrees(math.asin(math.sin(e) * math.sin(l)))
+    return ra, dec
+
+def twilight(when, step=60.):
+    """The UTC time the Sun is next below TWILIGHT, to within step seconds. If it already is, returns when."""
+    sra, sdec = sun(when)
+    offsets = np.arange(0., 86400., step)
+    sunel, _, _ = altaz(np.repeat(sra, len(offsets)), np.repeat(sdec, len(offsets)), when, offsets)
+    below = np.nonzero(sunel < TWILIGHT)[0]
+    if len(below) == 0:
+        return when
+    return when + timedelta(seconds=float(offsets[below[0]]))
+
+def altaz(ra, dec, when, offset=0.0):
+    """ Returns arrays of elevation, azimuth (degrees, N through E) and airmass for the targets at a UTC time.
+    offset is added to the time in seconds, and may be an array with one entry per target. """
+    ha  = np.radians(lst(when, offset) - ra)
+    dec = np.radians(dec)
+    lat = math.radians(latitude)
+    sinel = np.sin(dec)*math.sin(lat) + np.cos(dec)*math.cos(lat)*np.cos(ha)
+    el = np.arcsin(np.clip(sinel, -1, 1))
+    az = np.arctan2(-np.cos(dec)*np.sin(ha), np.sin(dec)*math.cos(lat) - np.cos(dec)*math.sin(lat)*np.cos(ha))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        airmass = np.where(el > 0, 1. / np.sin(el), np.inf)
+    return np.degrees(el), np.mod(np.degrees(az), 360.), airmass
+
+def hourangle(ra, when):
+    """Hour angle of the targets in hours, wrapped to -12 to 12."""
+    return np.mod(lst(when) - ra + 180., 360.) / 15. - 12.
+
+def observable(sl, when, wvel=0.0, waz=0.0, durations=None):
+    """ Returns a boolean mask of observable targets and a list of reasons, empty where observable.
+    If durations (seconds, one per target) are given, targets must also stay above the limits and the night
+    must not end before the exposure does. """
+    el, az, airmass = altaz(sl.ra, sl.dec, when)
+    # Later checks take precedence over earlier ones when reporting
+    code = np.zeros(len(sl), dtype=int)
+    if durations is not None:
+        durations = np.asarray(durations, dtype=float)
+        eel, _, eam = altaz(sl.ra, sl.dec, when, durations)
+        code[(eel < MIN_EL) | (eam > MAX_AIRMASS)] = 6
+        sra, sdec = sun(when)
+        sunel, _, _ = altaz(np.array([sra]), np.array([sdec]), when)
+        if sunel[0] < TWILIGHT:
+            endsun, _, _ = altaz(np.repeat(sra, len(sl)), np.repeat(sdec, len(sl)), when, durations)
+            code[endsun > TWILIGHT] = 7
+    code[airmass > MAX_AIRMASS] = 1
+    code[el > MAX_EL] = 2
+    code[el < MIN_EL] = 3
+    code[el <= 0] = 4
+    if wvel > WIND_EXCLUDE_SPEED:
+        dist = np.abs(np.mod(az - waz + 180., 360.) - 180.)
+        code[(dist < WIND_EXCLUDE_ANGLE) & (code == 0)] = 5
+    reasons = ['',
+               'airmass > %.1f' % MAX_AIRMASS,
+               'above dome limit el > %.0f' % MAX_EL,
+               'below el limit %.0f' % MIN_EL,
+               'below horizon',
+               'within %.0f deg of wind az %.0f' % (WIND_EXCLUDE_ANGLE, waz),
+               'sets before the exposure ends',
+               'exposure would run past twilight']
+    return code == 0, [reasons[c] for c in code]
+
+def filterStarlist(filename, outfile, when=None, wvel=0.0, waz=0.0, predict=None):
+    """ Drops unobservable targets from a star list at the expected start time and writes the rest to outfile.
+    predict, if given, is called with the parsed Starlist and returns the median, low and high exposure time
+    for each target. The high estimate is used to drop targets that would set or run into twilight.
+    Returns the number of targets kept and a list of (name, reason) for those dropped, including lines that couldn't be parsed. """
+    if when is None:
+        when = datetime.utcnow()
+    sl = Starlist(filename)
+    if len(sl) == 0:
+        sl.write(outfile, [])
+        return 0, list(sl.unparsed)
+    durations = None
+    if predict is not None:
+        durations = predict(sl)[2]
+    ok, reason = observable(sl, when, wvel, waz, durations)
+    keep = np.nonzero(ok)[0]
+    sl.write(outfile, keep)
+    dropped = sl.unparsed + [(sl.names[i], reason[i]) for i in np.nonzero(~ok)[0]]
+    return len(keep), dropped
@@ -0,0 +1,180 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# stateBus.py
+# Publishes the state of the APF into a shared memory segment so status tools don't need their own keyword monitors.
+# Running this file starts the publishing daemon.
+
+import os
+import sys
+import mmap
+import time
+import struct
+
+from apflog import *
+
+BusFile = '/dev/shm/apf_state'
+
+# Bump VERSION whenever FIELDS changes, readers refuse a layout they don't know.
+MAGIC   = 'APFS'
+VERSION = 1
+FIELDS = [('time',       'd'),
+          ('sunel',      'd'),
+          ('aaz',        'd'),
+          ('ael',        'd'),
+          ('fspos',      'd'),
+          ('rspos',      'd'),
+          ('aafocus',    'd'),
+          ('wvel',       'd'),
+          ('waz',        'd'),
+          ('seeing',     'd'),
+          ('slowdown',   'd'),
+          ('dmtime',     'd'),
+          ('openOK',     '?'),
+          ('isopen',     '?'),
+          ('running',    '?'),
+          ('conditions', '8s'),
+          ('teqmode',    '16s'),
+          ('whatsopen',  '64s'),
+          ('opreason',   '128s'),
+          ('weather',    '64s')]
+
+HEADER = struct.Struct('=4sIQ')
+BODY   = struct.Struct('=' + ''.join(f[1] for f in FIELDS))
+SIZE   = HEADER.size + BODY.size
+# Offset of the sequence counter in the header
+SEQ    = struct.Struct('=Q')
+SEQOFF = 8
+
+
+def formatState(st):
+    """Formats a state dictionary as the human readable telescope status."""
+    s = ''
+    s += "At %s state of telescope is:\n" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(st['time']))
+    s += "Sun elevation = %4.2f %s\n" % (st['sunel'], "Rising" if time.localtime(st['time']).tm_hour < 12 else "Setting")
+    s += "Telescope -- AZ=%4.2f  EL=%4.2f \n" % (st['aaz'], st['ael'])
+    s += "Front/Rear Shutter=%4.2f / %4.2f\n" % (st['fspos'], st['rspos'])
+    s += "Wind = %3.1f mph @ %4.1f deg\n" % (st['wvel'], st['waz'])
+    s += "Seeing %4.2f arcsec\n" % st['seeing']
+    s += "Slowdown = %5.2f x\n" % st['slowdown']
+    s += "Teq Mode - %s\n" % st['teqmode']
+    s += "M2 Focus Value = % 4.3f\n" % st['aafocus']
+    s += "Okay to open = %s -- %s\n" % (repr(st['openOK']), st['opreason'])
+    s += "Current Weather = %s\n" % st['weather']
+    if st['isopen']:
+        s += "Currently open: %s\n" % st['whatsopen']
+    else:
+        s += "Not currently open\n"
+    if st['running']:
+        s += "Robot is running\n"
+    else:
+        s += "Robot is not running\n"
+    return s
+
+
+def _open(path, size, create):
+    if create:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0664)
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        return fd, mmap.mmap(fd, size)
+    fd = os.open(path, os.O_RDONLY)
+    return fd, mmap.mmap(fd, size, prot=mmap.PROT_READ)
+
+
+class StatePublisher:
+    """ Single writer of the shared state segment.
+    Uses a sequence lock: the counter is odd while the body is being written and even when it is consistent. """
+
+    def __init__(self, path=BusFile):
+        self.path = path
+        self.fd, self.mm = _open(path, SIZE, True)
+        self.seq = 0
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.seq)
+
+    def publish(self, st):
+        values = []
+        for name, fmt in FIELDS:
+            v = st[name]
+            if fmt.endswith('s'):
+                v = str(v)
+            values.append(v)
+        self.seq += 1
+        SEQ.pack_into(self.mm, SEQOFF, self.seq)
+        BODY.pack_into(self.mm, HEADER.size, *values)
+        self.seq += 1
+        SEQ.pack_into(self.mm, SEQOFF, self.seq)
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+class StateReader:
+    """ Lock free reader of the shared state segment. Values are unpacked straight out of the mapping. """
+
+    def __init__(self, path=BusFile):
+        self.path = path
+        self.fd, self.mm = _open(path, SIZE, False)
+        magic, version, _ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("%s has layout %s/%d, expected %s/%d" % (path, repr(magic), version, MAGIC, VERSION))
+
+    def snapshot(self, retries=1000):
+        """Returns a consistent copy of the published state as a dictionary, along with its sequence number."""
+        for _ in xrange(retries):
+            s1, = SEQ.unpack_from(self.mm, SEQOFF)
+            if s1 & 1:
+                continue
+            values = BODY.unpack_from(self.mm, HEADER.size)
+            s2, = SEQ.unpack_from(self.mm, SEQOFF)
+            if s1 == s2:
+                st = dict()
+                for (name, fmt), v in zip(FIELDS, values):
+                    if fmt.endswith('s'):
+                        v = v.rstrip('\0')
+                    st[name] = v
+                return st, s1
+        raise RuntimeError("Couldn't get a consistent snapshot of %s" % self.path)
+
+    def age(self):
+        """Seconds since the state was last published."""
+        st, _ = self.snapshot()
+        return time.time() - st['time']
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+def connect(path=BusFile, maxage=10):
+    """Returns a StateReader if a publisher has updated the segment within maxage seconds, otherwise None."""
+    try:
+        reader = StateReader(path)
+    except (OSError, IOError, ValueError, mmap.error):
+        return None
+    if reader.age() > maxage:
+        reader.close()
+        return None
+    return reader
+
+
+if __name__ == '__main__':
+    import APFControl as ad
+
+    period = 1.0
+    if len(sys.argv) > 1:
+        period = float(sys.argv[1])
+
+    # Test mode guarantees the daemon never modifies the telescope state
+    apf = ad.APF(task='example', test=True)
+    pub = StatePublisher()
+    apflog("Publishing APF state to %s every %.1f s" % (BusFile, period), echo=True)
+    try:
+        while True:
+            try:
+                pub.publish(apf.state())
+            except Exception as e:
+                apflog("Couldn't publish APF state: %s" % e, echo=True)
+            time.sleep(period)
+    except KeyboardInterrupt:
+        pub.close()
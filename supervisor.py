@@ -0,0 +1,90 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# supervisor.py
+# Cooperative cancellation and liveness supervision for the master watcher thread.
+
+import time
+import threading
+
+from apflog import *
+
+# Seconds without a heartbeat before the watcher is considered wedged. Longer than any one keyword read, see APFControl.KTL_TIMEOUT
+STALL = 20.
+# Seconds given to a cancelled watcher to exit before escalating
+STOP_TIMEOUT = 15.
+# Restarts allowed before escalating
+MAX_RESTARTS = 3
+
+
+class Cancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """ Shared flag checked at every blocking point. wait() sleeps, but returns as soon as the token is cancelled. """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        self.event.set()
+
+    def wait(self, timeout):
+        """Sleeps for up to timeout seconds. Returns True if the token was cancelled."""
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+    def check(self):
+        """Raises Cancelled if the token has been cancelled."""
+        if self.event.is_set():
+            raise Cancelled()
+
+
+class Supervisor:
+    """ Watches the heartbeat of a worker thread. A worker that stalls is cancelled and replaced using
+    restart(old), which returns a new, unstarted worker. If the worker won't stop, or it keeps
+    stalling, check() returns False and the caller has to escalate. """
+
+    def __init__(self, worker, restart, stall=STALL, maxRestarts=MAX_RESTARTS):
+        self.worker = worker
+        self.restart = restart
+        self.stall = stall
+        self.maxRestarts = maxRestarts
+        self.restarts = 0
+
+    def stalled(self):
+        return time.time() - self.worker.heartbeat > self.stall
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """Cancels the worker and waits for it to exit. Returns True if it did."""
+        self.worker.signal = False
+        self.worker.token.cancel()
+        self.worker.join(timeout)
+        return not self.worker.is_alive()
+
+    def check(self):
+        """ Returns True while everything is fine, or after a successful restart.
+        A worker that has exited while its signal is still set died, and is treated like a stalled one. """
+        w = self.worker
+        if not w.signal:
+            return True
+        if w.is_alive():
+            if not self.stalled():
+                return True
+            apflog("Watcher heartbeat is %.0f s old. Stopping it." % (time.time() - w.heartbeat), level='warn', echo=True)
+            if not self.stop():
+                apflog("Watcher did not stop within %.0f s of being cancelled." % STOP_TIMEOUT, level='error', echo=True)
+                return False
+        else:
+            apflog("Watcher exited without being stopped.", level='warn', echo=True)
+        if self.restarts >= self.maxRestarts:
+            apflog("Watcher has stalled or died %d times. Not restarting it." % (self.restarts + 1), level='error', echo=True)
+            return False
+        self.restarts += 1
+        apflog("Restarting the watcher (restart %d of %d)." % (self.restarts, self.maxRestarts), level='warn', echo=True)
+        self.worker = self.restart(w)
+        self.worker.start()
+        return True
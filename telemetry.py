@@ -0,0 +1,231 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# telemetry.py
+# Multi-resolution rollups of the guider and weather telemetry, kept in memory and on disk.
+
+import os
+import time
+import struct
+import threading
+from collections import deque
+
+import numpy as np
+
+TelemetryDir = '/u/rjhanson/master/telemetry/'
+
+# Bucket width in seconds, and the number of closed buckets kept in memory for each width:
+# an hour of 1 s buckets, a day of 1 min buckets and a week of 10 min buckets.
+TIERS = [(1, 3600), (60, 1440), (600, 1008)]
+# Columns of a bucket, and how they are written to disk
+COLUMNS = ('time', 'min', 'max', 'mean', 'median', 'count')
+RECORD = struct.Struct('<dddddd')
+# query() picks the finest tier that returns at most this many buckets
+MAX_POINTS = 2000
+
+
+class Bucket:
+    """ An open bucket. Samples are added with add(), or finished buckets of the tier below with merge().
+    The median of a merged bucket is the median of the medians below it. """
+
+    def __init__(self, start):
+        self.start = start
+        self.min = None
+        self.max = None
+        self.sum = 0.
+        self.count = 0
+        self.medians = []
+
+    def add(self, value):
+        self.merge((self.start, value, value, value, value, 1))
+
+    def merge(self, rec):
+        t, lo, hi, mean, median, count = rec
+        if self.count == 0 or lo < self.min:
+            self.min = lo
+        if self.count == 0 or hi > self.max:
+            self.max = hi
+        self.sum += mean * count
+        self.count += count
+        self.medians.append(median)
+
+    def close(self):
+        return (float(self.start), self.min, self.max, self.sum / self.count, float(np.median(self.medians)), float(self.count))
+
+
+class Series:
+    """ The tiers of one keyword. Closed buckets are kept in a ring per tier and appended to one file per tier. """
+
+    def __init__(self, name, directory=None, tiers=TIERS):
+        self.name = name
+        self.widths = [w for w, n in tiers]
+        self.closed = [deque(maxlen=n) for w, n in tiers]
+        self.open = [None] * len(tiers)
+        self.files = [None] * len(tiers)
+        self.paths = [None] * len(tiers)
+        if directory is not None:
+            self.paths = [os.path.join(directory, "%s.%ds" % (name, w)) for w in self.widths]
+
+    def add(self, value, now):
+        start = now - now % self.widths[0]
+        b = self.open[0]
+        if b is not None and start < b.start:
+            # Out of order sample, it goes in the current bucket
+            start = b.start
+        if b is None or start > b.start:
+            self.close(0, start)
+            self.open[0] = b = Bucket(start)
+        b.add(value)
+
+    def close(self, tier, now):
+        """Closes the bucket of the tier if now is past its end, and passes it on to the tier above."""
+        b = self.open[tier]
+        if b is None or now < b.start + self.widths[tier]:
+            return
+        self.open[tier] = None
+        rec = b.close()
+        self.closed[tier].append(rec)
+        self.write(tier, rec)
+        if tier + 1 < len(self.widths):
+            width = self.widths[tier + 1]
+            start = b.start - b.start % width
+            up = self.open[tier + 1]
+            if up is not None and start > up.start:
+                self.close(tier + 1, start)
+                up = None
+            if up is None:
+                self.open[tier + 1] = up = Bucket(start)
+            up.merge(rec)
+
+    def flush(self, now):
+        """Closes every bucket that has ended by now, and writes the files out."""
+        for tier in range(len(self.widths)):
+            self.close(tier, now)
+        for f in self.files:
+            if f is not None:
+                f.flush()
+
+    def write(self, tier, rec):
+        if self.paths[tier] is None:
+            return
+        if self.files[tier] is None:
+            self.files[tier] = open(self.paths[tier], 'ab')
+        self.files[tier].write(RECORD.pack(*rec))
+
+    def read(self, tier, t0, t1):
+        """Reads the closed buckets starting between t0 and t1 from disk. Records are in time order, so this is a bisection."""
+        path = self.paths[tier]
+        if path is None or not os.path.exists(path):
+            return []
+        if self.files[tier] is not None:
+            self.files[tier].flush()
+        size = RECORD.size
+        with open(path, 'rb') as f:
+            f.seek(0, 2)
+            n = f.tell() // size
+            lo, hi = 0, n
+            while lo < hi:
+                mid = (lo + hi) // 2
+                f.seek(mid * size)
+                if RECORD.unpack(f.read(size))[0] < t0:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            f.seek(lo * size)
+            recs = []
+            for i in range(lo, n):
+                rec = RECORD.unpack(f.read(size))
+                if rec[0] >= t1:
+                    break
+                recs.append(rec)
+        return recs
+
+    def query(self, tier, t0, t1):
+        ring = self.closed[tier]
+        if self.paths[tier] is not None and (not ring or ring[0][0] > t0):
+            recs = self.read(tier, t0, t1)
+        else:
+            recs = [r for r in ring if t0 <= r[0] < t1]
+        return np.array(recs, dtype=float).reshape(-1, len(COLUMNS))
+
+    def close_files(self):
+        for i, f in enumerate(self.files):
+            if f is not None:
+                f.close()
+                self.files[i] = None
+
+
+class RollupStore:
+    """ Streaming downsampler for the high rate monitored keywords. Every keyword gets buckets of each width in TIERS
+    holding the min, max, mean, median and count of its samples. Memory use is fixed, closed buckets
+    are also appended to TelemetryDir so long range queries read a few kilobytes instead of raw samples. """
+
+    def __init__(self, directory=TelemetryDir, tiers=TIERS):
+        self.directory = directory
+        self.tiers = list(tiers)
+        self.series = dict()
+        self.lock = threading.Lock()
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def add(self, name, value, now=None):
+        """Adds a sample of the named keyword."""
+        if now is None:
+            now = time.time()
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        if value != value:
+            return
+        with self.lock:
+            s = self.series.get(name)
+            if s is None:
+                s = self.series[name] = Series(name, self.directory, self.tiers)
+            s.add(value, now)
+
+    def flush(self, now=None):
+        """Closes the buckets that have ended, even for keywords that have stopped updating."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for s in self.series.values():
+                s.flush(now)
+
+    def names(self):
+        return sorted(self.series.keys())
+
+    def query(self, name, t0, t1=None, width=None):
+        """ Returns the closed buckets of name starting in [t0, t1) as an array with the columns in COLUMNS.
+        If no bucket width is given, the finest one that gives at most MAX_POINTS buckets is used. """
+        if t1 is None:
+            t1 = time.time()
+        widths = [w for w, n in self.tiers]
+        if width is None:
+            tier = len(widths) - 1
+            for i, w in enumerate(widths):
+                if (t1 - t0) / w <= MAX_POINTS:
+                    tier = i
+                    break
+        else:
+            tier = widths.index(width)
+        with self.lock:
+            s = self.series.get(name)
+            if s is None:
+                s = Series(name, self.directory, self.tiers)
+            return s.query(tier, t0, t1)
+
+    def summary(self, name, seconds, now=None):
+        """Min, max, mean, median and count of name over the last seconds, or None if there is no data."""
+        if now is None:
+            now = time.time()
+        b = self.query(name, now - seconds, now)
+        if len(b) == 0:
+            return None
+        count = b[:,5].sum()
+        return dict(min=b[:,1].min(), max=b[:,2].max(), mean=(b[:,3] * b[:,5]).sum() / count,
+                    median=float(np.median(b[:,4])), count=int(count))
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for s in self.series.values():
+                s.close_files()
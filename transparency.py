@@ -0,0 +1,79 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# transparency.py
+# Watches the guider transparency to decide when an exposure under clouds is no longer worth finishing.
+
+import time
+from collections import deque
+
+import numpy as np
+
+# Seconds of transparency in the fast window and in the baseline
+FAST_WINDOW = 30.
+BASELINE_WINDOW = 900.
+# Cloudy when the fast median falls below this fraction of the baseline median
+DROP_FRACTION = 0.3
+# The drop must last this long, and the exposure must have run this long, before aborting
+MIN_DWELL = 60.
+MIN_ELAPSED = 60.
+# Abort when the projected counts at the end of the exposure are below this fraction of the threshold
+MIN_COUNT_FRACTION = 0.5
+
+
+class TransparencyMonitor:
+    """ Keeps the guider transparency (measured / expected count rate) over a short and a long window.
+    A sustained drop of the short window against the long one means clouds. """
+
+    def __init__(self, fast=FAST_WINDOW, baseline=BASELINE_WINDOW, drop=DROP_FRACTION, dwell=MIN_DWELL):
+        self.fast = fast
+        self.baseline = baseline
+        self.drop = drop
+        self.dwell = dwell
+        self.samples = deque()
+        self.cloudySince = None
+
+    def add(self, speed, rate, now=None):
+        """Adds a transparency sample along with the measured count rate."""
+        if now is None:
+            now = time.time()
+        self.samples.append((now, speed, rate))
+        while self.samples and now - self.samples[0][0] > self.baseline:
+            self.samples.popleft()
+        if self.cloudy(now):
+            if self.cloudySince is None:
+                self.cloudySince = now
+        else:
+            self.cloudySince = None
+
+    def _window(self, now, width, col):
+        return np.array([s[col] for s in self.samples if now - s[0] <= width], dtype=float)
+
+    def cloudy(self, now=None):
+        """True if the fast window transparency has dropped below the threshold fraction of the baseline."""
+        if now is None:
+            now = time.time()
+        fast = self._window(now, self.fast, 1)
+        base = self._window(now, self.baseline, 1)
+        if len(fast) == 0 or len(base) < 2 * len(fast):
+            return False
+        return np.median(fast) < self.drop * np.median(base)
+
+    def rate(self, now=None):
+        """Median count rate over the fast window."""
+        if now is None:
+            now = time.time()
+        r = self._window(now, self.fast, 2)
+        if len(r) == 0:
+            return 0.0
+        return float(np.median(r))
+
+    def shouldAbort(self, counts, thresh, elapsed, exptime, now=None):
+        """ True if the exposure can no longer reach a useful fraction of its count threshold.
+        counts and thresh are the accumulated and target guider counts, elapsed and exptime are in seconds. """
+        if now is None:
+            now = time.time()
+        if self.cloudySince is None or now - self.cloudySince < self.dwell:
+            return False
+        if elapsed < MIN_ELAPSED or thresh <= 0:
+            return False
+        projected = counts + self.rate(now) * max(exptime - elapsed, 0.)
+        return projected < MIN_COUNT_FRACTION * thresh
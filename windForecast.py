@@ -0,0 +1,110 @@
+#!/usr/bin/env  /opt/kroot/bin/kpython
+# windForecast.py
+# Short horizon wind trend forecast, used for windshielding and to avoid starting exposures right before a forced close.
+
+import time
+from collections import deque
+
+import numpy as np
+
+# Seconds of history kept, and used for the trend fit
+HISTORY = 3600.
+TREND_WINDOW = 900.
+# How far ahead windshielding decisions look, seconds
+HORIZON = 600.
+# Closure forecasts never look further ahead than this
+MAX_HORIZON = 900.
+# Percentile of the fit residuals added to the trend, so the forecast covers gusts
+PERCENTILE = 90
+# Windshielding turns off only once the forecast is this far (mph) below the limit and has been on this long (s)
+HYSTERESIS = 3.0
+MIN_HOLD = 600.
+# OPEN_OK drops are weighted by exp(-age / FLAP_DECAY) seconds to give a drop rate. A closure is likely when
+# that rate predicts at least MAX_DROPS drops during the exposure.
+FLAP_DECAY = 900.
+MAX_DROPS = 0.5
+
+
+class WindForecaster:
+    """ Fits a linear trend to the recent wind speed and forecasts a percentile of the speed a few minutes ahead. """
+
+    def __init__(self):
+        self.wind = deque()
+        self.ok = deque()
+        self.shielded = None
+        self.changed = 0.
+
+    def add(self, wvel, waz, now=None):
+        """Adds a wind speed (mph) and direction (radians) sample."""
+        if now is None:
+            now = time.time()
+        self.wind.append((now, wvel, waz))
+        while self.wind and now - self.wind[0][0] > HISTORY:
+            self.wind.popleft()
+
+    def addOK(self, ok, now=None):
+        """Records a change of the OPEN_OK permission."""
+        if now is None:
+            now = time.time()
+        if self.ok and self.ok[-1][1] == ok:
+            return
+        self.ok.append((now, ok))
+        while self.ok and now - self.ok[0][0] > HISTORY:
+            self.ok.popleft()
+
+    def trend(self, now=None):
+        """Returns the current fitted speed (mph), the slope (mph per minute) and the fit residuals."""
+        if now is None:
+            now = time.time()
+        w = np.array([(t, v) for t, v, _ in self.wind if now - t <= TREND_WINDOW], dtype=float)
+        if len(w) == 0:
+            return 0.0, 0.0, np.zeros(1)
+        if len(w) < 3 or np.ptp(w[:,0]) == 0:
+            return float(np.median(w[:,1])), 0.0, w[:,1] - np.median(w[:,1])
+        dt = (w[:,0] - now) / 60.
+        slope, icept = np.polyfit(dt, w[:,1], 1)
+        return float(icept), float(slope), w[:,1] - (icept + slope*dt)
+
+    def forecast(self, horizon=HORIZON, pct=PERCENTILE, now=None):
+        """The pct percentile of the wind speed forecast horizon seconds ahead, mph."""
+        speed, slope, resid = self.trend(now)
+        # Only extrapolate a rising trend, a falling one may just be a lull
+        return speed + max(slope, 0.) * horizon / 60. + max(np.percentile(resid, pct), 0.)
+
+    def windshield(self, limit, now=None):
+        """ Returns True if windshielding should be on. Turns on as soon as the forecast crosses the limit,
+        and only turns off once the forecast is well below it and it has been on for a while. """
+        if now is None:
+            now = time.time()
+        f = self.forecast(now=now)
+        if self.shielded is None:
+            self.shielded = f > limit
+            self.changed = now
+        elif not self.shielded and f > limit:
+            self.shielded = True
+            self.changed = now
+        elif self.shielded and f < limit - HYSTERESIS and now - self.changed > MIN_HOLD:
+            self.shielded = False
+            self.changed = now
+        return self.shielded
+
+    def okNow(self):
+        """The last OPEN_OK value recorded, True if there is none."""
+        if not self.ok:
+            return True
+        return self.ok[-1][1]
+
+    def dropRate(self, now=None):
+        """Recent OPEN_OK drops per second, with older drops counting for less."""
+        if now is None:
+            now = time.time()
+        return sum(np.exp(-(now - t) / FLAP_DECAY) for t, ok in self.ok if not ok) / FLAP_DECAY
+
+    def closeLikely(self, limit, duration, now=None):
+        """ True if OPEN_OK is false right now, if the recent OPEN_OK drops make one likely within the next
+        duration seconds, or if the wind is forecast to pass limit within them. """
+        if not self.okNow():
+            return True
+        if self.dropRate(now) * duration >= MAX_DROPS:
+            return True
+        return self.forecast(min(duration, MAX_HORIZON), now=now) > limit